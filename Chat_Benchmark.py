@@ -0,0 +1,580 @@
+"""
+Micro-benchmarks for the chat system
+
+    python Chat_Benchmark.py codec [-n 20000]
+    python Chat_Benchmark.py startup [-n 10] [--top 10]
+    python Chat_Benchmark.py tls [--fanout 2 8 32] [-m 500] [--cert cert.pem --key key.pem]
+    python Chat_Benchmark.py video [--source synthetic] [--fps 20] [--seconds 10] [--send-delay 0]
+    python Chat_Benchmark.py restart [--clients 20] [--interval 10]
+    python Chat_Benchmark.py heartbeat [--live 20] [--dead 20] [--interval 0.5]
+    python Chat_Benchmark.py io [--fanout 8 32] [-m 2000]
+    python Chat_Benchmark.py p2p [--size 20]
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import queue
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from Chat_Protocol import CODECS, CallData, ChatMessage, FrameReader, PrivateMessage, encode_frame, make_hello
+
+AUDIO_PACKET = os.urandom(2048)    # 1024 frames of 16-bit mono, one CHUNK
+VIDEO_FRAME = os.urandom(24000)    # a 640x480 JPEG at quality 50, roughly
+
+
+def codec_samples(binary):
+    """(label, message) pairs; media is raw bytes on binary codecs, base64 text otherwise."""
+    media = (lambda b: b) if binary else (lambda b: base64.b64encode(b).decode('ascii'))
+    return [
+        ('chat', ChatMessage(sender='alice', room='General', message='see you at the standup in 5', timestamp='09:41:07')),
+        ('private', PrivateMessage(sender='alice', recipient='bob', message='did the build pass?', timestamp='09:41:09')),
+        ('call_data/audio', CallData(sender='alice', data_type='audio', data=media(AUDIO_PACKET))),
+        ('call_data/video', CallData(sender='alice', data_type='video', data=media(VIDEO_FRAME))),
+        ('presence', {'type': 'presence', 'version': 42, 'joined': ['carol', 'dave'], 'left': ['erin']}),
+        ('file_offer', {'type': 'file_offer', 'file_id': '504b7f9def7d29cb', 'sender': 'carol', 'filename': 'notes.txt',
+                        'filetype': '.txt', 'size': 18211, 'timestamp': '09:42:00'}),
+    ]
+
+def bench_codec(args):
+    print(f"{'codec':<8} {'message':<16} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for name, codec in CODECS.items():
+        for label, msg in codec_samples(codec.binary):
+            frame = encode_frame(msg, 'len', 'none', name)
+            reader = FrameReader('len', name)
+            start = time.perf_counter()
+            for _ in range(args.n): encode_frame(msg, 'len', 'none', name)
+            enc = (time.perf_counter() - start) / args.n * 1e6
+            start = time.perf_counter()
+            for _ in range(args.n): reader.feed(frame)
+            dec = (time.perf_counter() - start) / args.n * 1e6
+            print(f"{name:<8} {label:<16} {len(frame):>7} {enc:>10.2f} {dec:>10.2f}")
+
+
+STARTUP_MODES = [
+    ('interpreter', "pass"),
+    ('text-only', "import Chat_Client"),
+    ('full media', "import Chat_Client; missing = Chat_Client.preload_media(); missing and print(*missing)"),
+]
+
+def _run_python(code, *flags):
+    """Wall time (ms) of a fresh interpreter running code, plus its stdout/stderr."""
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, *flags, '-c', code], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    return (time.perf_counter() - start) * 1000, proc
+
+def bench_startup(args):
+    """Client start cost: a fresh process importing Chat_Client, with and without the media stack."""
+    print(f"{'mode':<12} {'median ms':>10} {'min ms':>8}")
+    for label, code in STARTUP_MODES:
+        times, proc = [], None
+        for _ in range(args.n):
+            ms, proc = _run_python(code)
+            times.append(ms)
+        note = f"  (missing: {proc.stdout.strip()})" if proc.stdout.strip() else ""
+        if proc.returncode: note = f"  (failed: {proc.stderr.strip().splitlines()[-1]})"
+        print(f"{label:<12} {statistics.median(times):>10.1f} {min(times):>8.1f}{note}")
+    # -X importtime lines: "import time: self | cumulative | name"
+    _, proc = _run_python(STARTUP_MODES[-1][1], '-X', 'importtime')
+    rows = []
+    for line in proc.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    print("\nslowest imports, full media (cumulative ms):")
+    for cumulative, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:>8.1f}  {name}")
+
+
+class BenchClient:
+    """Minimal protocol client: hello/welcome, then a reader thread timing chat deliveries."""
+    def __init__(self, port, name, tls=None, session=None, features=()):
+        start = time.perf_counter()
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        if tls: self.sock = tls.wrap_socket(self.sock, server_hostname='localhost', session=session)
+        self.sock.sendall((json.dumps(make_hello(name, ['presence', *features])) + "\n").encode('utf-8'))
+        data = b""
+        while b"\n" not in data: data += self.sock.recv(4096)
+        line, self.leftover = data.split(b"\n", 1)
+        welcome = json.loads(line)
+        self.connect_ms = (time.perf_counter() - start) * 1000
+        self.session = self.sock.session if tls else None
+        self.resumed = tls is not None and self.sock.session_reused
+        self.wire = (welcome['framing'], welcome['compression'], welcome['codec'])
+        self.latencies = []
+        self.last_receipt = 0.0
+
+    def start_reading(self, expect):
+        self.done = threading.Event()
+        threading.Thread(target=self._read, args=(expect,), daemon=True).start()
+
+    def _read(self, expect):
+        reader, data = FrameReader(self.wire[0], self.wire[2]), self.leftover
+        while True:
+            for msg in reader.feed(data):
+                if msg.get('type') == 'chat':
+                    now = time.perf_counter()
+                    self.latencies.append(now - float(msg['message'].split(' ', 1)[0]))
+                    self.last_receipt = now
+            if len(self.latencies) >= expect: break
+            data = self.sock.recv(1024 * 1024)
+            if not data: break
+        self.done.set()
+
+    def send(self, data):
+        self.sock.sendall(encode_frame(data, *self.wire))
+
+def _self_signed_cert(folder):
+    cert, key = os.path.join(folder, 'cert.pem'), os.path.join(folder, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                    '-days', '1', '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'],
+                   check=True, capture_output=True)
+    return cert, key
+
+def _start_server(*options, port=None, wait=True, output=subprocess.DEVNULL):
+    """Chat_Server.py in its own process (its own GIL, logging discarded by default); returns (process, port)."""
+    if port is None:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, os.path.join(here, 'Chat_Server.py'), '--host', '127.0.0.1',
+                             '--port', str(port), '--connect-rate', '10000', '--connect-burst', '10000', *options],
+                            stdout=output, stderr=subprocess.DEVNULL, text=True)
+    for _ in range(250 if wait else 0):
+        try: socket.create_connection(('127.0.0.1', port)).close(); break
+        except OSError: time.sleep(0.02)
+    return proc, port
+
+def _fanout_run(port, tls, fanout, messages, size, interval, features=()):
+    """
+    One sender broadcasting to `fanout` receivers: `messages` paced sends for latency, then
+    the same number back to back for throughput. Returns (connect ms list, latencies, deliveries/s).
+    """
+    tag = f"{'tls' if tls else 'tcp'}{fanout}"
+    receivers, session = [], None
+    for i in range(fanout):
+        client = BenchClient(port, f"{tag}-r{i}", tls, session, features)
+        session = client.session or session
+        receivers.append(client)
+    sender = BenchClient(port, f"{tag}-s", tls, session, features)
+    time.sleep(0.5)  # let presence settle
+    for client in receivers: client.start_reading(2 * messages)
+    filler = 'x' * size
+    for _ in range(messages):
+        sender.send({'type': 'chat', 'room': 'General', 'message': f"{time.perf_counter()} {filler}"})
+        time.sleep(interval)
+    while min(len(c.latencies) for c in receivers) < messages and not any(c.done.is_set() for c in receivers):
+        time.sleep(0.01)
+    latencies = [lat for c in receivers for lat in c.latencies[:messages]]
+    start = time.perf_counter()
+    for _ in range(messages):
+        sender.send({'type': 'chat', 'room': 'General', 'message': f"{time.perf_counter()} {filler}"})
+    for client in receivers: client.done.wait(60)
+    elapsed = max(c.last_receipt for c in receivers) - start
+    for client in receivers + [sender]: client.sock.close()
+    return [c.connect_ms for c in receivers + [sender]], latencies, fanout * messages / elapsed
+
+def bench_tls(args):
+    """Plain TCP vs TLS: connect cost (full/resumed handshake), broadcast latency and throughput."""
+    import Chat_Client
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        cert, key = (args.cert, args.key or args.cert) if args.cert else _self_signed_cert(folder)
+        client_tls = Chat_Client.make_tls_context(cert)
+        for tls in (None, client_tls):
+            server, port = _start_server(*(['--tls-cert', cert, '--tls-key', key] if tls else []))
+            try:
+                for fanout in args.fanout:
+                    results.append((tls is not None, fanout) +
+                                   _fanout_run(port, tls, fanout, args.messages, args.size, args.interval / 1000))
+                if tls:
+                    full, resumed = [], []
+                    first = BenchClient(port, 'hs-0', client_tls)
+                    for i in range(args.handshakes):
+                        client = BenchClient(port, f"hs-f{i}", client_tls)
+                        full.append(client.connect_ms); client.sock.close()
+                        client = BenchClient(port, f"hs-r{i}", client_tls, first.session)
+                        (resumed if client.resumed else full).append(client.connect_ms); client.sock.close()
+            finally:
+                server.terminate(); server.wait()
+    print(f"{'transport':<10} {'fanout':>6} {'connect ms':>11} {'p50 ms':>8} {'p99 ms':>8} {'deliveries/s':>13}")
+    for tls, fanout, connects, latencies, rate in results:
+        latencies.sort()
+        p50, p99 = latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"{'TLS' if tls else 'TCP':<10} {fanout:>6} {statistics.median(connects):>11.2f} {p50:>8.2f} {p99:>8.2f} {rate:>13.0f}")
+    print(f"\nTLS connect (tcp + handshake + hello/welcome): full {statistics.median(full):.2f} ms, "
+          f"resumed {statistics.median(resumed) if resumed else float('nan'):.2f} ms ({len(resumed)} resumed)")
+
+
+def bench_io(args):
+    """Frame-per-send vs coalesced (sendmsg) output: send calls per frame, broadcast latency and throughput."""
+    results = []
+    for label, options in (('per frame', ['--no-coalesce']), ('coalesced', [])):
+        server, port = _start_server(*options, '--flush-window', str(args.flush_window), output=subprocess.PIPE)
+        try:
+            for fanout in args.fanout:
+                connects, latencies, rate = _fanout_run(port, None, fanout, args.messages, args.size,
+                                                        args.interval / 1000, features=['resume'])
+                latencies.sort()
+                results.append([label, fanout, latencies[len(latencies) // 2] * 1000,
+                                latencies[int(len(latencies) * 0.99)] * 1000, rate])
+        finally:
+            server.terminate()
+            log = server.communicate()[0]
+        writes = [line for line in log.splitlines() if line.startswith('[SERVER] Wrote')]
+        per_frame = float(writes[-1].rsplit('(', 1)[1].split()[0]) if writes else float('nan')
+        for row in results[-len(args.fanout):]: row.append(per_frame)
+    print(f"{'output':<10} {'fanout':>6} {'p50 ms':>8} {'p99 ms':>8} {'deliveries/s':>13} {'sends/frame':>12}")
+    for label, fanout, p50, p99, rate, per_frame in results:
+        print(f"{label:<10} {fanout:>6} {p50:>8.2f} {p99:>8.2f} {rate:>13.0f} {per_frame:>12.3f}")
+    print("(sends/frame covers the whole run: paced latency phase plus back-to-back flood, all fanouts)")
+
+class FileClient:
+    """Protocol client whose reader thread queues every message (file transfer runs)."""
+    def __init__(self, port, name, features=()):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.sendall((json.dumps(make_hello(name, ['presence', *features])) + "\n").encode('utf-8'))
+        data = b""
+        while b"\n" not in data: data += self.sock.recv(4096)
+        line, leftover = data.split(b"\n", 1)
+        welcome = json.loads(line)
+        self.wire = (welcome['framing'], welcome['compression'], welcome['codec'])
+        self.inbox = queue.Queue()
+        threading.Thread(target=self._read, args=(leftover,), daemon=True).start()
+
+    def _read(self, data):
+        reader = FrameReader(self.wire[0], self.wire[2])
+        try:
+            while True:
+                for msg in reader.feed(data): self.inbox.put(msg)
+                data = self.sock.recv(1024 * 1024)
+                if not data: break
+        except OSError:
+            pass
+
+    def send(self, data):
+        self.sock.sendall(encode_frame(data, *self.wire))
+
+    def wait_for(self, mtype, timeout=120):
+        deadline = time.monotonic() + timeout
+        while True:
+            msg = self.inbox.get(timeout=max(0.01, deadline - time.monotonic()))
+            if msg.get('type') == mtype: return msg
+
+def _process_usage(pid):
+    """(CPU seconds, peak RSS MB) of a process so far (Linux /proc)."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open(f"/proc/{pid}/status") as f:
+        peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+    return cpu, peak / 1024
+
+def bench_p2p(args):
+    """One private file, relayed through the server vs brokered peer-to-peer: time and server cost."""
+    import Chat_Client
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'payload.bin')
+        with open(path, 'wb') as f: f.write(os.urandom(int(args.size * 1024 * 1024)))
+        with open(path, 'rb') as f: digest = hashlib.sha256(f.read()).hexdigest()
+        for mode in ('relay', 'direct'):
+            server, port = _start_server('--p2p-files')
+            try:
+                alice = FileClient(port, 'alice', ['p2p_files'])
+                bob = FileClient(port, 'bob', ['p2p_files'])
+                time.sleep(0.3)
+                before = _process_usage(server.pid)
+                start = time.perf_counter()
+                if mode == 'relay':
+                    with open(path, 'rb') as f: filedata = base64.b64encode(f.read()).decode('ascii')
+                    alice.send({'type': 'file', 'recipient': 'bob', 'filename': 'payload.bin', 'filetype': '.bin', 'filedata': filedata})
+                    received = base64.b64decode(bob.wait_for('file')['filedata'])
+                else:
+                    sender = Chat_Client.P2PSender(path)
+                    alice.send({'type': 'p2p_offer', 'recipient': 'bob', 'transfer_id': 'bench', 'filename': 'payload.bin',
+                                'filetype': '.bin', 'size': sender.size, 'port': sender.port})
+                    sender.authorize(alice.wait_for('p2p_ready')['token'])
+                    offer = bob.wait_for('p2p_offer')
+                    target = os.path.join(folder, 'received.bin')
+                    Chat_Client.p2p_receive(offer, lambda: (open(target, 'wb'), target))
+                    bob.send({'type': 'p2p_result', 'transfer_id': offer['transfer_id'], 'ok': True})
+                    alice.wait_for('p2p_result')
+                    with open(target, 'rb') as f: received = f.read()
+                elapsed = time.perf_counter() - start
+                after = _process_usage(server.pid)
+                ok = hashlib.sha256(received).hexdigest() == digest
+                results.append((mode, elapsed * 1000, after[0] - before[0], after[1], ok))
+            finally:
+                server.terminate(); server.wait()
+    print(f"{args.size:g} MB private file, alice -> bob on localhost")
+    print(f"{'path':<8} {'ms':>8} {'server cpu s':>13} {'server peak MB':>15} {'intact':>7}")
+    for mode, ms, cpu, peak, ok in results:
+        print(f"{mode:<8} {ms:>8.0f} {cpu:>13.2f} {peak:>15.1f} {'yes' if ok else 'NO':>7}")
+
+class ResumingClient:
+    """Resumable client that, like Chat_Client, reconnects with its session on 'server_restart'."""
+    def __init__(self, port, name):
+        self.port, self.name = port, name
+        self.token, self.last_seq = None, 0
+        self.received = {}      # chat message -> receipt time
+        self.duplicates = self.resumed = 0
+        self.skipped = 0        # sequence numbers that never arrived
+        self.reconnect_ms = []
+        self.outbox = []
+        self.lock = threading.Lock()
+        self.closed = False
+        leftover = self._connect()
+        threading.Thread(target=self._read, args=(leftover,), daemon=True).start()
+
+    def _connect(self):
+        extra = {'resume': {'token': self.token, 'last_seq': self.last_seq}} if self.token else {}
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=10)
+        sock.sendall((json.dumps(make_hello(self.name, ['presence', 'resume'], **extra)) + "\n").encode('utf-8'))
+        data = b""
+        while b"\n" not in data:
+            chunk = sock.recv(4096)
+            if not chunk: raise ConnectionError("closed during handshake")
+            data += chunk
+        line, leftover = data.split(b"\n", 1)
+        welcome = json.loads(line)
+        if welcome.get('type') != 'welcome': raise ConnectionError(welcome.get('message'))
+        sock.settimeout(None)
+        self.token = welcome.get('session')
+        self.resumed += bool(welcome.get('resumed'))
+        self.wire = (welcome['framing'], welcome['compression'], welcome['codec'])
+        self.reader = FrameReader(self.wire[0], self.wire[2])
+        with self.lock:
+            for message in self.outbox: sock.sendall(encode_frame(message, *self.wire))
+            self.outbox, self.sock = [], sock
+        return leftover
+
+    def _read(self, data):
+        while not self.closed:
+            try:
+                restart = False
+                for msg in self.reader.feed(data):
+                    seq = msg.pop('seq', None)
+                    if seq is not None:
+                        if seq <= self.last_seq: self.duplicates += 1; continue
+                        self.skipped += seq - self.last_seq - 1
+                        self.last_seq = seq
+                    if msg.get('type') == 'server_restart': restart = True
+                    elif msg.get('type') == 'chat': self.received[msg['message']] = time.perf_counter()
+                if restart: raise ConnectionError("server restart")
+                data = self.sock.recv(1024 * 1024)
+                if not data: raise ConnectionError("closed")
+            except (OSError, ValueError):
+                if self.closed: return
+                with self.lock:
+                    self.sock.close()
+                    self.sock = None
+                start = time.perf_counter()
+                while not self.closed:
+                    try: data = self._connect(); break
+                    except (OSError, ValueError): time.sleep(0.05)
+                self.reconnect_ms.append((time.perf_counter() - start) * 1000)
+
+    def send(self, message):
+        with self.lock:
+            if self.sock is None: self.outbox.append(message)
+            else: self.sock.sendall(encode_frame(message, *self.wire))
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            if self.sock: self.sock.close()
+
+def bench_restart(args):
+    """A server hands over to a new process (--handoff) under chat traffic: what do clients notice?"""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'handoff.sock')
+        old, port = _start_server('--handoff', path)
+        receivers = [ResumingClient(port, f"r{i}") for i in range(args.clients)]
+        sender = ResumingClient(port, 'sender')
+        time.sleep(0.5)
+        sent, stop = [], threading.Event()
+        def traffic():
+            while not stop.is_set():
+                sent.append(f"{len(sent)}")
+                sender.send({'type': 'chat', 'room': 'General', 'message': sent[-1]})
+                time.sleep(args.interval / 1000)
+        threading.Thread(target=traffic, daemon=True).start()
+        time.sleep(args.before)
+        started = time.perf_counter()
+        new, _ = _start_server('--handoff', path, port=port, wait=False)
+        old.wait(30)
+        handover_ms = (time.perf_counter() - started) * 1000
+        time.sleep(args.after)
+        stop.set()
+        time.sleep(1.0)
+        for client in receivers + [sender]: client.close()
+        new.terminate(); new.wait()
+    lost = [len(sent) - sum(1 for m in sent if m in c.received) for c in receivers]
+    gaps = []
+    for c in receivers:
+        times = sorted(c.received.values())
+        gaps.append(max((b - a for a, b in zip(times, times[1:])), default=0) * 1000)
+    reconnects = [ms for c in receivers + [sender] for ms in c.reconnect_ms]
+    print(f"{len(sent)} messages to {args.clients} receivers, one every {args.interval:.0f} ms; the old process exited "
+          f"{handover_ms:.0f} ms after the new one was launched (including its startup)")
+    print(f"resumed sessions: {sum(c.resumed for c in receivers + [sender])}/{args.clients + 1}, "
+          f"reconnect ms median {statistics.median(reconnects) if reconnects else float('nan'):.0f} max {max(reconnects, default=0):.0f}")
+    print(f"lost messages: {sum(lost)} (worst receiver {max(lost)}), duplicates: {sum(c.duplicates for c in receivers)}, "
+          f"skipped sequence numbers: {sum(c.skipped for c in receivers)}")
+    print(f"longest delivery gap ms: median {statistics.median(gaps):.0f}, max {max(gaps):.0f}")
+
+class HeartbeatClient:
+    """'heartbeat' client; a live one answers pings and pings the server, a dead one stays silent."""
+    def __init__(self, port, name, live):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.sendall((json.dumps(make_hello(name, ['presence', 'heartbeat'])) + "\n").encode('utf-8'))
+        data = b""
+        while b"\n" not in data: data += self.sock.recv(4096)
+        line, leftover = data.split(b"\n", 1)
+        welcome = json.loads(line)
+        self.wire = (welcome['framing'], welcome['compression'], welcome['codec'])
+        self.live = live
+        self.pings = {}        # our ping id -> send time
+        self.rtt = []
+        self.closed_at = None  # when the server dropped us
+        self.lock = threading.Lock()
+        threading.Thread(target=self._read, args=(leftover,), daemon=True).start()
+
+    def _read(self, data):
+        reader = FrameReader(self.wire[0], self.wire[2])
+        try:
+            while True:
+                for msg in reader.feed(data):
+                    if not self.live: continue
+                    if msg.get('type') == 'ping': self.send({'type': 'pong', 'id': msg.get('id')})
+                    elif msg.get('type') == 'pong' and msg.get('id') in self.pings:
+                        self.rtt.append(time.perf_counter() - self.pings.pop(msg['id']))
+                data = self.sock.recv(65536)
+                if not data: break
+        except OSError:
+            pass
+        self.closed_at = time.perf_counter()
+
+    def send(self, data):
+        with self.lock: self.sock.sendall(encode_frame(data, *self.wire))
+
+    def ping(self, ping_id):
+        self.pings[ping_id] = time.perf_counter()
+        self.send({'type': 'ping', 'id': ping_id})
+
+def bench_heartbeat(args):
+    """Live clients next to ones that went silent: how fast are the silent ones reaped, and never the live ones?"""
+    from Chat_Protocol import HEARTBEAT_MISSES
+    server, port = _start_server('--heartbeat-interval', str(args.interval))
+    try:
+        live = [HeartbeatClient(port, f"live{i}", True) for i in range(args.live)]
+        dead = [HeartbeatClient(port, f"dead{i}", False) for i in range(args.dead)]
+        went_quiet = time.perf_counter()
+        timeout = args.interval * HEARTBEAT_MISSES
+        deadline = went_quiet + timeout + args.seconds
+        ping_id = 0
+        while time.perf_counter() < deadline:
+            ping_id += 1
+            for client in live:
+                try: client.ping(ping_id)
+                except OSError: pass
+            time.sleep(args.interval)
+        for client in live + dead: client.sock.close()
+    finally:
+        server.terminate(); server.wait()
+    reaped = sorted(c.closed_at - went_quiet for c in dead if c.closed_at)
+    rtt = sorted(r for c in live for r in c.rtt)
+    print(f"heartbeat interval {args.interval:g}s, timeout {timeout:g}s ({HEARTBEAT_MISSES} missed)")
+    print(f"silent clients reaped: {len(reaped)}/{args.dead}" + (f", after {statistics.median(reaped):.2f}s median, "
+          f"{reaped[-1]:.2f}s max" if reaped else ""))
+    print(f"live clients dropped: {sum(1 for c in live if c.closed_at and c.closed_at < deadline)}/{args.live}")
+    if rtt:
+        print(f"ping rtt ms: p50 {rtt[len(rtt) // 2] * 1000:.2f}, p99 {rtt[int(len(rtt) * 0.99)] * 1000:.2f} ({len(rtt)} pongs)")
+
+def bench_video(args):
+    """VideoPipeline against a frame source (synthetic by default: runs headless, no camera)."""
+    import Chat_Client
+    source = Chat_Client.make_frame_source(args.source)
+    sizes, sends = [], []
+    def send(data):
+        sends.append(time.perf_counter()); sizes.append(len(data))
+        if args.send_delay: time.sleep(args.send_delay / 1000)  # a slow link / stalled socket
+    pipeline = Chat_Client.VideoPipeline(source, send, fps=args.fps, quality=args.quality)
+    pipeline.start()
+    time.sleep(args.seconds)
+    pipeline.stop()
+    source.release()
+    intervals = [(b - a) * 1000 for a, b in zip(sends, sends[1:])]
+    sent = max(pipeline.sent, 1)
+    print(f"target {args.fps} fps, {args.seconds:.0f}s, source {args.source}, send delay {args.send_delay:.0f} ms")
+    print(f"captured {pipeline.captured} ({pipeline.captured / args.seconds:.1f} fps), "
+          f"sent {pipeline.sent} ({pipeline.sent / args.seconds:.1f} fps), late ticks {pipeline.late}")
+    print(f"dropped: {pipeline.dropped_raw} before encode, {pipeline.dropped_encoded} before send")
+    if intervals:
+        print(f"send interval ms: median {statistics.median(intervals):.1f}, stdev {statistics.pstdev(intervals):.1f}, "
+              f"max {max(intervals):.1f}")
+    print(f"encode {pipeline.encode_seconds / max(pipeline.encoded_frames, 1) * 1000:.2f} ms/frame, "
+          f"{statistics.mean(sizes) if sizes else 0:.0f} bytes/frame, "
+          f"capture->send {pipeline.pipeline_seconds / sent * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat system benchmarks")
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('codec', help="encode/decode cost and frame size per message type and codec")
+    p.add_argument('-n', type=int, default=20000, help="iterations per message")
+    p.set_defaults(run=bench_codec)
+    p = sub.add_parser('startup', help="client import time, text-only vs. full media stack")
+    p.add_argument('-n', type=int, default=10, help="runs per mode")
+    p.add_argument('--top', type=int, default=10, help="slowest imports to list")
+    p.set_defaults(run=bench_startup)
+    p = sub.add_parser('tls', help="plain TCP vs TLS: handshake cost, broadcast latency and throughput")
+    p.add_argument('--fanout', type=int, nargs='+', default=[2, 8, 32], help="receivers per broadcast")
+    p.add_argument('-m', '--messages', type=int, default=500, help="broadcasts per run")
+    p.add_argument('--size', type=int, default=200, help="chat message size (bytes)")
+    p.add_argument('--interval', type=float, default=2.0, help="ms between paced (latency) sends")
+    p.add_argument('--handshakes', type=int, default=20, help="full/resumed TLS handshakes to time")
+    p.add_argument('--cert', help="server certificate (default: a throwaway self-signed one, needs openssl)")
+    p.add_argument('--key')
+    p.set_defaults(run=bench_tls)
+    p = sub.add_parser('restart', help="zero-downtime restart (--handoff): pause, loss and resumes seen by clients")
+    p.add_argument('--clients', type=int, default=20, help="receiving clients")
+    p.add_argument('--interval', type=float, default=10, help="ms between chat messages")
+    p.add_argument('--before', type=float, default=1.0, help="seconds of traffic before the restart")
+    p.add_argument('--after', type=float, default=2.0, help="seconds of traffic after the old process exits")
+    p.set_defaults(run=bench_restart)
+    p = sub.add_parser('heartbeat', help="idle reaping: silent clients dropped after the heartbeat timeout, live ones kept")
+    p.add_argument('--live', type=int, default=20, help="clients that answer pings")
+    p.add_argument('--dead', type=int, default=20, help="clients that go silent after logging in")
+    p.add_argument('--interval', type=float, default=0.5, help="server --heartbeat-interval (seconds)")
+    p.add_argument('--seconds', type=float, default=2.0, help="how long to keep running past the timeout")
+    p.set_defaults(run=bench_heartbeat)
+    p = sub.add_parser('io', help="write coalescing: send calls per frame, latency and throughput vs one send per frame")
+    p.add_argument('--fanout', type=int, nargs='+', default=[8, 32], help="receivers per broadcast")
+    p.add_argument('-m', '--messages', type=int, default=2000, help="broadcasts per run")
+    p.add_argument('--size', type=int, default=100, help="chat message size (bytes)")
+    p.add_argument('--interval', type=float, default=1.0, help="ms between paced (latency) sends")
+    p.add_argument('--flush-window', type=float, default=0.0, help="server --flush-window (ms)")
+    p.set_defaults(run=bench_io)
+    p = sub.add_parser('p2p', help="private file relayed through the server vs sent directly: time and server cost")
+    p.add_argument('--size', type=float, default=20, help="file size (MB)")
+    p.set_defaults(run=bench_p2p)
+    p = sub.add_parser('video', help="video pipeline: achieved fps, jitter, encode cost, drops")
+    p.add_argument('--source', default='synthetic', help="'synthetic', 'file:<path>' or 'camera[:index]'")
+    p.add_argument('--fps', type=float, default=20)
+    p.add_argument('--quality', type=int, default=30, help="JPEG quality (the client uses 30)")
+    p.add_argument('--seconds', type=float, default=10)
+    p.add_argument('--send-delay', type=float, default=0, help="ms each send blocks, to simulate a slow link")
+    p.set_defaults(run=bench_video)
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,250 @@
+"""
+On-demand profiling of a running server, and the tool that triggers it
+
+Server:   python Chat_Server.py --admin /tmp/chat-admin.sock
+Profile:  python Chat_Profiler.py /tmp/chat-admin.sock [--seconds 10] [--spans] [--no-allocations] [--out DIR]
+
+Nothing is instrumented until a profile is requested. For --seconds the server then:
+  * times every inbound message in process_message, per message type (wall and CPU time)
+  * samples every thread's stack PROFILE_SAMPLE_RATE times a second into collapsed stacks
+    ("thread;outer;...;inner count" lines: the input of flamegraph.pl, inferno or speedscope).
+    A thread waiting on a condition or in accept(), or whose frame hasn't moved since the previous
+    sample (blocked in recv, say), is counted as idle and left out, unless --all-threads
+  * traces allocations with tracemalloc and reports where memory grew (slows allocation while on)
+  * with --spans, times the stages each message goes through:
+      receive  its bytes came off the socket -> it starts routing (decoding its read, and the
+               messages ahead of it in that read)
+      decode   its share of decoding the read it arrived in
+      route    process_message, less the time spent encoding
+      encode   encoding the frames it was delivered as (once per wire format)
+      send     per delivery: queued on a connection -> written to the socket
+    and "message", receive + route + encode: from the socket to queued for every recipient.
+The report (summary.txt and stacks.folded) is written to a folder on the server host;
+the summary is printed here as well.
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from datetime import datetime
+
+PROFILE_SECONDS = 10.0
+PROFILE_MAX_SECONDS = 600.0
+PROFILE_SAMPLE_RATE = 100   # stack samples per second
+PROFILE_FOLDER = 'profiles'
+TRACEMALLOC_FRAMES = 1      # only the allocating line is reported
+SPAN_SAMPLES = 100000       # kept per stage for the percentiles (the most recent)
+REPORT_ROWS = 15
+STAGES = ('receive', 'decode', 'route', 'encode', 'send', 'message')
+IDLE_CODES = {threading.Condition.wait.__code__, socket.socket.accept.__code__}  # innermost frame of a parked thread
+
+
+def thread_group(name):
+    """'Thread-12 (handle_client)' -> 'handle_client', 'handshake_3' -> 'handshake'."""
+    match = re.fullmatch(r'Thread-\d+ \((.+)\)', name)
+    return match.group(1) if match else re.sub(r'[_-]\d+$', '', name)
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+# ---------------- Profile ----------------
+class Profiler:
+    """One profiling run. The server calls route() per inbound message, timed(encode) and sent() with --spans."""
+    def __init__(self, spans=False, allocations=True, rate=PROFILE_SAMPLE_RATE, all_threads=False):
+        self.spans = spans
+        self.allocations = allocations
+        self.rate = rate
+        self.all_threads = all_threads
+        self.lock = threading.Lock()
+        self.handlers = {}  # message type -> [count, wall seconds, cpu seconds, max wall]
+        self.stages = {stage: deque(maxlen=SPAN_SAMPLES) for stage in STAGES}
+        self.local = threading.local()  # encode seconds spent by this thread on the current message
+        self.stacks = Counter()
+        self.samples = self.idle_samples = 0
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.own_tracemalloc = False
+        self.snapshot = self.growth = None
+        self.started = self.elapsed = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.own_tracemalloc = True
+            self.snapshot = tracemalloc.take_snapshot()
+        if self.rate:
+            self.sampler = threading.Thread(target=self._sample_loop, name='profiler', daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler: self.sampler.join()
+        self.elapsed = time.perf_counter() - self.started
+        if self.allocations:
+            ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+            end = tracemalloc.take_snapshot().filter_traces(ignore)
+            self.growth = [s for s in end.compare_to(self.snapshot.filter_traces(ignore), 'lineno') if s.size_diff]
+            self.snapshot = None
+            if self.own_tracemalloc: tracemalloc.stop()
+
+    # ---------- hooks (called from the server's threads) ----------
+    def route(self, process, sender, message, received, decode):
+        """process(sender, message), timed. received: perf_counter() when its read returned; decode: its share."""
+        try: mtype = str(message.get('type'))
+        except AttributeError: mtype = '?'
+        local = self.local
+        local.encode = 0.0
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            process(sender, message)
+        finally:
+            end = time.perf_counter()
+            wall, cpu = end - start, time.thread_time() - cpu
+            with self.lock:
+                stats = self.handlers.get(mtype)
+                if stats is None: stats = self.handlers[mtype] = [0, 0.0, 0.0, 0.0]
+                stats[0] += 1; stats[1] += wall; stats[2] += cpu
+                if wall > stats[3]: stats[3] = wall
+            if self.spans:
+                stages = self.stages  # deque.append is atomic: no lock
+                stages['receive'].append(start - received)
+                stages['decode'].append(decode)
+                stages['route'].append(wall - local.encode)
+                stages['encode'].append(local.encode)
+                stages['message'].append(end - received)
+
+    def timed(self, encode):
+        """encode_frame, adding its time to the calling thread's current message."""
+        local = self.local
+        def encode_frame(*args, **kwargs):
+            start = time.perf_counter()
+            try: return encode(*args, **kwargs)
+            finally: local.encode = getattr(local, 'encode', 0.0) + time.perf_counter() - start
+        return encode_frame
+
+    def sent(self, queued):
+        """Frames queued at these perf_counter() times have just been written."""
+        now = time.perf_counter()
+        samples = self.stages['send']
+        for t in queued: samples.append(now - t)
+
+    # ---------- stack sampler ----------
+    def _sample_loop(self):
+        interval = 1.0 / self.rate
+        own = threading.get_ident()
+        names, last, labels = {}, {}, {}
+        while not self.stopped.wait(interval):
+            frames = sys._current_frames()
+            if not frames.keys() <= names.keys():
+                names = {t.ident: thread_group(t.name) for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own: continue
+                self.samples += 1
+                where = (id(frame), frame.f_lasti)
+                if not self.all_threads and (frame.f_code in IDLE_CODES or last.get(ident) == where):
+                    self.idle_samples += 1
+                    continue
+                last[ident] = where
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread'))
+                self.stacks[';'.join(reversed(stack))] += 1
+            frames = frame = None  # don't keep the sampled frames (and their locals) alive
+
+    # ---------- report ----------
+    def report(self, folder):
+        """Writes summary.txt and stacks.folded into folder; returns the summary."""
+        os.makedirs(folder, exist_ok=True)
+        lines = [f"Profile of {self.elapsed:.1f} s, {datetime.now():%Y-%m-%d %H:%M:%S}", ""]
+
+        with self.lock:
+            handlers = sorted(self.handlers.items(), key=lambda item: -item[1][1])
+        total = sum(stats[1] for _, stats in handlers) or 1.0
+        lines.append(f"Handlers (process_message per message type): {sum(s[0] for _, s in handlers)} messages, "
+                     f"{total * 1000:.1f} ms")
+        lines.append(f"  {'type':<20}{'count':>9}{'total ms':>11}{'mean us':>10}{'max ms':>9}{'cpu ms':>10}{'share':>8}")
+        for mtype, (count, wall, cpu, worst) in handlers:
+            lines.append(f"  {mtype:<20}{count:>9}{wall * 1000:>11.1f}{wall / count * 1e6:>10.1f}"
+                         f"{worst * 1000:>9.2f}{cpu * 1000:>10.1f}{wall / total:>8.1%}")
+
+        if self.spans:
+            lines += ["", "Stages (us; send is per delivery, message = receive + route + encode)",
+                      f"  {'stage':<12}{'count':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+            for stage in STAGES:
+                ordered = sorted(self.stages[stage])
+                if not ordered: continue
+                lines.append(f"  {stage:<12}{len(ordered):>9}" + "".join(
+                    f"{percentile(ordered, p) * 1e6:>10.1f}" for p in (0.5, 0.95, 0.99)) + f"{ordered[-1] * 1e6:>10.1f}")
+
+        if self.rate:
+            busy = self.samples - self.idle_samples
+            leaves = Counter()
+            for stack, count in self.stacks.items(): leaves[stack.rsplit(';', 1)[-1]] += count
+            lines += ["", f"Busiest functions (innermost frame of {busy} busy stack samples; "
+                          f"{self.idle_samples} idle samples left out)"]
+            for label, count in leaves.most_common(REPORT_ROWS):
+                lines.append(f"  {count / (busy or 1):>6.1%}  {label}")
+            with open(os.path.join(folder, 'stacks.folded'), 'w') as f:
+                for stack, count in sorted(self.stacks.items()): f.write(f"{stack} {count}\n")
+
+        if self.growth is not None:
+            lines += ["", f"Allocations (growth since the profile started: {sum(s.size_diff for s in self.growth) / 1024:+.1f} KiB)"]
+            for stat in self.growth[:REPORT_ROWS]:
+                frame = stat.traceback[0]
+                lines.append(f"  {stat.size_diff / 1024:>+10.1f} KiB {stat.count_diff:>+8} blocks  "
+                             f"{os.path.basename(frame.filename)}:{frame.lineno}")
+
+        files = ['summary.txt'] + (['stacks.folded'] if self.rate else [])
+        lines += ["", "Written to " + ", ".join(os.path.join(folder, name) for name in files)]
+        summary = "\n".join(lines) + "\n"
+        with open(os.path.join(folder, 'summary.txt'), 'w') as f:
+            f.write(summary)
+        return summary
+
+
+# ---------------- Admin client ----------------
+def request(path, command, timeout=None):
+    """Sends one admin command (a dict) to the server's --admin socket; returns its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(command).encode() + b"\n")
+        reply = b""
+        while not reply.endswith(b"\n"):
+            data = sock.recv(65536)
+            if not data: break
+            reply += data
+    return json.loads(reply)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile a running server (started with --admin PATH)")
+    parser.add_argument('admin', help="the server's --admin socket")
+    parser.add_argument('--seconds', type=float, default=PROFILE_SECONDS)
+    parser.add_argument('--spans', action='store_true', help="also time receive/decode/route/encode/send per message")
+    parser.add_argument('--no-allocations', action='store_true', help="skip tracemalloc")
+    parser.add_argument('--rate', type=int, default=PROFILE_SAMPLE_RATE, help="stack samples per second (0: off)")
+    parser.add_argument('--all-threads', action='store_true', help="sample idle threads too")
+    parser.add_argument('--out', help=f"report folder on the server host (default {PROFILE_FOLDER}/<time>)")
+    args = parser.parse_args()
+    command = {'command': 'profile', 'seconds': args.seconds, 'spans': args.spans, 'allocations': not args.no_allocations,
+               'rate': args.rate, 'all_threads': args.all_threads, 'folder': args.out}
+    print(f"Profiling for {args.seconds:g} s...")
+    reply = request(args.admin, command)
+    if not reply.get('ok'): sys.exit("Profile failed: " + reply.get('error', 'unknown error'))
+    print(reply['summary'], end="")
@@ -0,0 +1,412 @@
+"""
+Wire protocol shared by Chat_Server.py and Chat_Client.py
+
+- Handshake: the client sends a single JSON 'hello' line, the server answers with a
+  'welcome' line (carrying the negotiated settings) or an 'error' line. Everything after
+  that uses the negotiated framing/compression.
+- Framing: 'ndjson' (legacy newline-delimited JSON) or 'len' (length-prefixed frames).
+- Compression: per-frame zlib on 'len' framing, only for frames where it pays off.
+- Codec: how a frame body is serialized, chosen per connection: 'msgpack' / 'orjson' when
+  those libraries are installed, stdlib 'json' always ('ndjson' framing is json only).
+  Hot message types (chat, private, call_data) are typed, slotted Message classes; binary
+  codecs send them positionally and can carry media as raw bytes instead of base64.
+- Fragments: on 'len' framing a large frame may be sent as FLAG_FRAGMENT slices so the
+  sender can interleave higher-priority frames between them (one fragmented frame at a time).
+- Sequence numbers: a FLAG_SEQ frame (4-byte body) numbers the next message on the wire
+  (for a fragmented message: the one whose first fragment follows). The reader puts it
+  into the decoded message as 'seq'; the encoded message body itself stays shareable.
+- Media: 'inband' (call_data on the main connection) or, where the server allows it,
+  'plain': the welcome carries a one-time 'media_token'; the client opens a second plaintext
+  connection, sends a 'media_hello' line (username, token), gets 'media_ready', and from then
+  on call_data in both directions uses that connection with the main connection's wire settings.
+- Call audio: clients with voice activity detection set 'vad' on audio call_data (1 speech,
+  0 hangover) and stay quiet in silence, sending a 'comfort_noise' call_data now and then
+  whose data is one byte, the background level in -dBov (RFC 3389 style). Receivers fill the
+  gaps; the server turns 'vad' into 'active_speaker' notices for group calls.
+- Presence ('presence' feature): after a 'client_list' snapshot (with its 'version') the
+  client gets versioned 'presence' deltas (joined, left) and asks for a new snapshot with
+  'presence_sync' when it sees a gap. Clients without the feature get the full 'client_list'
+  whenever someone comes or goes.
+- Heartbeats ('heartbeat' feature): the welcome carries 'heartbeat', the ping interval in
+  seconds. Either side that has heard nothing from the other for that long sends
+  {'type':'ping','id':n}; the other answers {'type':'pong','id':n} at once. A peer silent
+  for HEARTBEAT_MISSES intervals is considered dead and its connection is closed.
+- Direct file transfer ('p2p_files', servers opt in): for a private file the sender listens
+  on an ephemeral port and sends 'p2p_offer' (recipient, transfer_id, file details, 'size' of
+  at most P2P_MAX_BYTES, and 'port'). The server pairs the port with the address it sees the
+  sender at (never an address the sender names), answers the sender 'p2p_ready' with a
+  one-time token and passes the offer, that endpoint and the token on. The
+  recipient connects to an endpoint, sends the token line, gets P2P_READY and reads exactly
+  'size' raw bytes; it reports 'p2p_result' (ok, reason), which the server forwards to the
+  sender. A failed (or refused) transfer is re-sent through the server as a 'file'.
+  The direct stream is not encrypted.
+- Room directory ('room_directory'): the welcome lists only the rooms the client is in, and
+  'room_created' goes only to its creator (and to clients without the feature). Other rooms are
+  browsed with {'type':'room_list_request','prefix','after','limit'}, answered by 'room_list'
+  (rooms: name, members, joined; 'next', the 'after' of the following page, or None), and
+  entered or left with 'join_room' / 'leave_room' ('room_joined' / 'room_left'). Room chat and
+  room search results only cover the rooms the client is in.
+- Legacy clients that send a bare username instead of a hello get protocol 0 / ndjson.
+"""
+
+import base64
+import json
+import socket
+import struct
+import zlib
+
+try:
+    import msgpack  # optional: compact binary codec
+except ImportError:
+    msgpack = None
+try:
+    import orjson   # optional: accelerated JSON
+except ImportError:
+    orjson = None
+
+PROTOCOL_VERSION = 1
+MIN_PROTOCOL_VERSION = 0
+
+# Preference order: first entry the other side also supports wins
+FRAMINGS = ('len', 'ndjson')
+COMPRESSIONS = ('zlib', 'none')
+MEDIA_TRANSPORTS = ('inband',)
+MEDIA_PLAIN = 'plain'  # call media on a second, plaintext connection (servers offer it only over TLS)
+
+# 'len' framing: 4-byte body length + 1 flag byte, then the body
+FRAME_HEADER = struct.Struct('!IB')
+FLAG_ZLIB = 0x01
+FLAG_FRAGMENT = 0x02  # body is a slice of a larger, complete frame
+FLAG_LAST = 0x04      # final slice; the reassembled bytes are decoded as one frame
+FLAG_SEQ = 0x08       # body is a sequence number for the next message
+SEQ = struct.Struct('!I')
+CHUNK_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+COMPRESS_MIN = 1024  # bytes; smaller frames are never worth compressing
+COMPRESS_LEVEL = 1
+
+# Liveness: application heartbeats, backed by kernel TCP keepalive for peers without them
+HEARTBEAT_MISSES = 3          # intervals of silence before a peer is declared dead
+KEEPALIVE_IDLE = 60           # seconds idle before the kernel starts probing
+KEEPALIVE_INTERVAL = 10       # seconds between probes
+KEEPALIVE_COUNT = 5           # unanswered probes before the connection is reset
+
+# Direct file transfer: the sender's answer to a valid token, before the raw file bytes
+P2P_READY = b'ok\n'
+P2P_TOKEN_MAX = 256  # bytes of token line the sender reads
+P2P_MAX_BYTES = 1024 * 1024 * 1024  # largest file offered directly
+
+# Per-class socket tuning. Fixed kernel buffers (which switch off Linux autotuning) bound how
+# much can queue below our priority lanes; 'recv' is what one read asks for (one CHUNK_SIZE fragment).
+SOCKET_CLASSES = {
+    'main':  {'sndbuf': 512 * 1024, 'rcvbuf': 512 * 1024, 'recv': 64 * 1024},  # chat, files, in-band media
+    'media': {'sndbuf': 64 * 1024, 'rcvbuf': 128 * 1024, 'recv': 64 * 1024},   # 'plain' call media: a few frames at most
+}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# ---------- typed messages ----------
+class Message:
+    """
+    Base for typed hot-path messages. Slotted (no per-instance dict) and readable like
+    the plain dicts used elsewhere: .get(), 'key' in msg, msg['key'].
+    """
+    __slots__ = ('seq',)
+    TYPE = None
+    CODE = 0
+    FIELDS = ()
+
+    def __init__(self, **fields):
+        self.seq = fields.get('seq')
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_dict(cls, data):
+        return data if isinstance(data, cls) else cls(**data)
+
+    @classmethod
+    def from_list(cls, items):
+        # A shorter list (an older peer) leaves the later fields None; a longer one isn't ours
+        if len(items) > len(cls.FIELDS) + 1: raise ProtocolError(f"too many fields for {cls.TYPE}")
+        msg = cls.__new__(cls)
+        msg.seq = None
+        for name in cls.FIELDS:
+            setattr(msg, name, None)
+        for name, value in zip(cls.FIELDS, items[1:]):
+            setattr(msg, name, value)
+        return msg
+
+    @classmethod
+    def list_from_dict(cls, data):
+        return [cls.CODE] + [data.get(name) for name in cls.FIELDS]
+
+    def to_list(self):
+        return [self.CODE] + [getattr(self, name) for name in self.FIELDS]
+
+    def to_dict(self):
+        data = {'type': self.TYPE}
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None: data[name] = value
+        return data
+
+    def get(self, key, default=None):
+        if key == 'type': return self.TYPE
+        value = getattr(self, key, None) if key in self.FIELDS or key == 'seq' else None
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None: raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key == 'seq' or key in self.FIELDS: setattr(self, key, None)
+        return value
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class ChatMessage(Message):
+    __slots__ = FIELDS = ('sender', 'room', 'message', 'timestamp')
+    TYPE, CODE = 'chat', 1
+
+class PrivateMessage(Message):
+    __slots__ = FIELDS = ('sender', 'recipient', 'message', 'timestamp')
+    TYPE, CODE = 'private', 2
+
+class CallData(Message):
+    __slots__ = FIELDS = ('sender', 'peer', 'room', 'data_type', 'data', 'vad')  # new fields go last
+    TYPE, CODE = 'call_data', 3
+
+MESSAGE_TYPES = {cls.TYPE: cls for cls in (ChatMessage, PrivateMessage, CallData)}
+MESSAGE_CODES = {cls.CODE: cls for cls in MESSAGE_TYPES.values()}
+
+
+# ---------- codecs ----------
+def _json_default(obj):
+    if isinstance(obj, Message): return obj.to_dict()
+    if isinstance(obj, (bytes, bytearray, memoryview)): return base64.b64encode(obj).decode('ascii')
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+def media_bytes(data):
+    """Media payloads arrive as raw bytes from binary codecs, as base64 text from JSON ones."""
+    if isinstance(data, (bytes, bytearray)): return bytes(data)
+    return base64.b64decode(data)
+
+class JsonCodec:
+    name = 'json'
+    binary = False  # bytes values are sent as base64 text
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':'), default=_json_default).encode('utf-8')
+    def loads(self, body):
+        return json.loads(body)
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+    def dumps(self, data):
+        return orjson.dumps(data, default=_json_default)
+    def loads(self, body):
+        return orjson.loads(body)
+
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, Message): return obj.to_list()
+        raise TypeError(f"{type(obj).__name__} is not serializable")
+    def dumps(self, data):
+        if isinstance(data, dict) and data.get('type') in MESSAGE_TYPES:
+            data = MESSAGE_TYPES[data['type']].list_from_dict(data)
+        return msgpack.packb(data, use_bin_type=True, default=self._default)
+    def loads(self, body):
+        obj = msgpack.unpackb(body, raw=False)
+        if isinstance(obj, list):
+            try: return MESSAGE_CODES[obj[0]].from_list(obj)
+            except (IndexError, KeyError, TypeError): raise ProtocolError("unknown typed message") from None
+        return obj
+
+CODECS = {codec.name: codec for codec, available in ((MsgpackCodec(), msgpack is not None),
+                                                      (OrjsonCodec(), orjson is not None),
+                                                      (JsonCodec(), True)) if available}
+
+
+# ---------- handshake ----------
+def make_hello(username, features=(), **extra):
+    hello = {'type':'hello','username':username,'protocol':PROTOCOL_VERSION,
+             'framing':list(FRAMINGS),'compression':list(COMPRESSIONS),
+             'media':list(MEDIA_TRANSPORTS),'codec':list(CODECS),'features':list(features)}
+    hello.update(extra)
+    return hello
+
+def _pick(offered, supported, default):
+    offered = offered or [default]
+    for choice in supported:
+        if choice in offered: return choice
+    raise ProtocolError(f"no common option in {offered}")
+
+def negotiate(hello, features=(), media=MEDIA_TRANSPORTS):
+    """Server side: pick settings for a client 'hello'. Raises ProtocolError."""
+    version = min(int(hello.get('protocol', 0)), PROTOCOL_VERSION)
+    if version < MIN_PROTOCOL_VERSION:
+        raise ProtocolError(f"protocol {version} not supported")
+    framing = _pick(hello.get('framing'), FRAMINGS, 'ndjson')
+    return {'protocol': version,
+            'framing': framing,
+            'compression': _pick(hello.get('compression'), COMPRESSIONS, 'none'),
+            'codec': _pick(hello.get('codec'), tuple(CODECS) if framing == 'len' else ('json',), 'json'),
+            'media': _pick(hello.get('media'), media, 'inband'),
+            'features': [f for f in hello.get('features', []) if f in features]}
+
+
+# ---------- sockets ----------
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """
+    TCP keepalive with our timings (the OS default waits two hours before the first probe).
+    Where supported, unacknowledged sends also give up after the same total time
+    (TCP_USER_TIMEOUT), so a writer blocked on a vanished peer is freed too.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(idle))
+    elif hasattr(socket, 'TCP_KEEPALIVE'):  # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, int(idle))
+    elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):  # Windows
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, int(idle * 1000), int(interval * 1000)))
+        return
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(interval))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, int(count))
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int((idle + interval * count) * 1000))
+
+
+def tune_socket(sock, kind='main'):
+    """TCP_NODELAY (writes are already whole frames) and the class's buffer sizes; returns its recv size."""
+    tuning = SOCKET_CLASSES[kind]
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, tuning['sndbuf'])
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, tuning['rcvbuf'])
+    return tuning['recv']
+
+
+# ---------- framing ----------
+def encode_frame(data, framing='ndjson', compression='none', codec='json'):
+    body = CODECS[codec].dumps(data)
+    if framing == 'ndjson':
+        return body + b"\n"
+    flags = 0
+    if compression == 'zlib' and len(body) >= COMPRESS_MIN:
+        packed = zlib.compress(body, COMPRESS_LEVEL)
+        if len(packed) < len(body):
+            body, flags = packed, flags | FLAG_ZLIB
+    return FRAME_HEADER.pack(len(body), flags) + body
+
+def seq_prefix(seq):
+    return FRAME_HEADER.pack(SEQ.size, FLAG_SEQ) + SEQ.pack(seq)
+
+def fragment_frame(frame, size=CHUNK_SIZE):
+    """Yields (wire bytes, payload length) slices of an encoded 'len' frame."""
+    view = memoryview(frame)
+    for pos in range(0, len(frame), size):
+        piece = view[pos:pos + size]
+        flags = FLAG_FRAGMENT | (FLAG_LAST if pos + size >= len(frame) else 0)
+        yield FRAME_HEADER.pack(len(piece), flags) + piece, len(piece)
+
+
+class FrameReader:
+    """Incremental decoder: feed() raw socket bytes, get back complete messages."""
+    def __init__(self, framing='ndjson', codec='json'):
+        self.framing = framing
+        self.codec = CODECS[codec]
+        self.buffer = bytearray()
+        self.partial = bytearray()  # fragments of the frame being reassembled
+        self.partial_seq = None
+        self.pending_seq = None     # from a FLAG_SEQ frame, for the next message
+        self.text = ""
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        if self.framing == 'ndjson':
+            return self._feed_ndjson(data)
+        return self._feed_len(data)
+
+    def _feed_ndjson(self, data):
+        messages = []
+        self.text += data.decode('utf-8', errors='ignore')
+        while self.text:
+            self.text = self.text.lstrip()
+            try:
+                obj, idx = self.decoder.raw_decode(self.text)
+            except ValueError: break
+            self.text = self.text[idx:]
+            messages.append(self._checked(obj))
+        return messages
+
+    def _feed_len(self, data):
+        messages = []
+        buf = self.buffer
+        buf += data
+        pos = 0
+        while len(buf) - pos >= FRAME_HEADER.size:
+            length, flags = FRAME_HEADER.unpack_from(buf, pos)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"frame too large ({length} bytes)")
+            start = pos + FRAME_HEADER.size
+            if len(buf) - start < length: break
+            pos = start + length
+            if flags & FLAG_SEQ:
+                if length != SEQ.size: raise ProtocolError("bad sequence frame")
+                self.pending_seq = SEQ.unpack_from(buf, start)[0]
+                continue
+            if flags & FLAG_FRAGMENT:
+                if not self.partial:
+                    self.partial_seq, self.pending_seq = self.pending_seq, None
+                self.partial += buf[start:pos]
+                if len(self.partial) > MAX_FRAME_SIZE + FRAME_HEADER.size:
+                    raise ProtocolError("fragmented frame too large")
+                if flags & FLAG_LAST:
+                    inner, self.partial = self.partial, bytearray()
+                    _, inner_flags = FRAME_HEADER.unpack_from(inner)
+                    messages.append(self._decode_body(inner[FRAME_HEADER.size:], inner_flags, self.partial_seq))
+                    self.partial_seq = None
+                continue
+            seq, self.pending_seq = self.pending_seq, None
+            messages.append(self._decode_body(buf[start:pos], flags, seq))
+        del buf[:pos]
+        return messages
+
+    def _decode_body(self, body, flags, seq=None):
+        body = bytes(body)
+        if flags & FLAG_ZLIB:
+            # MAX_FRAME_SIZE bounds the inflated size too: a small frame must not expand into gigabytes
+            inflater = zlib.decompressobj()
+            try: body = inflater.decompress(body, MAX_FRAME_SIZE)
+            except zlib.error as e: raise ProtocolError(f"bad compressed frame ({e})") from None
+            if inflater.unconsumed_tail or not inflater.eof:
+                raise ProtocolError("compressed frame too large or truncated")
+        try: message = self.codec.loads(body)
+        except ProtocolError: raise
+        except Exception as e: raise ProtocolError(f"undecodable frame ({e})") from None
+        message = self._checked(message)
+        if seq is not None: message['seq'] = seq
+        return message
+
+    @staticmethod
+    def _checked(obj):
+        # Everything past the reader may rely on getting a message (a dict or a typed Message)
+        if isinstance(obj, (dict, Message)): return obj
+        raise ProtocolError(f"not a message ({type(obj).__name__})")
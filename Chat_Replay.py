@@ -0,0 +1,301 @@
+"""
+Traffic capture format and replay tool
+
+Capture (on the server):  python Chat_Server.py --capture traffic.trace
+Replay:                   python Chat_Replay.py traffic.trace [--speed 1 | N | 0] [--baseline old/Chat_Server.py]
+
+The trace is a gzip stream: TRACE_MAGIC, then records of TRACE_RECORD (kind, seconds since
+capture start, user id, body length) + body. A user's first record is preceded by a
+TRACE_USER record naming it; logins carry the negotiated features, messages are the inbound
+message as compact JSON. Replay starts a fresh server, logs in one synthetic client per
+captured user over loopback and re-sends every message on the captured schedule (scaled by
+--speed, 0 = as fast as possible), timing how long each takes to reach its recipients.
+
+Any Chat_Server.py version can be replayed: only the command-line options its source
+mentions are passed, one without --port is reached on its fixed LEGACY_PORT, and one that
+predates the hello is logged into with a bare username.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from Chat_Protocol import CODECS, FrameReader, encode_frame, make_hello
+
+TRACE_MAGIC = b'CHATTRC1'
+LEGACY_PORT = 5555  # where a server without --port listens
+SERVER_OPTIONS = {'--host': '127.0.0.1', '--connect-rate': '100000', '--connect-burst': '100000'}  # when supported
+TRACE_RECORD = struct.Struct('!BdII')  # kind, seconds since capture start, user id, body length
+TRACE_USER, TRACE_LOGIN, TRACE_MESSAGE, TRACE_LOGOUT = range(1, 5)
+TRACE_FLUSH_INTERVAL = 1.0  # seconds; a killed server still leaves a readable trace
+
+
+# ---------------- Capture ----------------
+class TraceWriter:
+    """Appends records from any thread; encoding, compression and I/O happen on a writer thread."""
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wb', compresslevel=1)
+        self.file.write(TRACE_MAGIC)
+        self.start = time.monotonic()
+        self.user_ids = {}
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self.thread.start()
+
+    def record(self, kind, username, data=None):
+        self.queue.put((kind, time.monotonic() - self.start, username, data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _writer_loop(self):
+        codec = CODECS['json']
+        last_flush = time.monotonic()
+        while True:
+            try: item = self.queue.get(timeout=TRACE_FLUSH_INTERVAL)
+            except queue.Empty: item = ()
+            if item is None: break
+            if item:
+                kind, when, username, data = item
+                uid = self.user_ids.get(username)
+                if uid is None:
+                    uid = self.user_ids[username] = len(self.user_ids)
+                    name = username.encode('utf-8')
+                    self.file.write(TRACE_RECORD.pack(TRACE_USER, when, uid, len(name)) + name)
+                try: body = codec.dumps(data) if data is not None else b""
+                except Exception as e:
+                    print("[TRACE] cannot record message:", e); continue
+                self.file.write(TRACE_RECORD.pack(kind, when, uid, len(body)) + body)
+            if time.monotonic() - last_flush >= TRACE_FLUSH_INTERVAL:
+                self.file.flush()
+                last_flush = time.monotonic()
+        self.file.close()
+
+def read_trace(path):
+    """Yields (kind, seconds, username, message or None); a truncated tail is ignored."""
+    names = {}
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a chat trace")
+        try:
+            while True:
+                head = f.read(TRACE_RECORD.size)
+                if len(head) < TRACE_RECORD.size: return
+                kind, when, uid, length = TRACE_RECORD.unpack(head)
+                body = f.read(length)
+                if len(body) < length: return
+                if kind == TRACE_USER:
+                    names[uid] = body.decode('utf-8')
+                    continue
+                yield kind, when, names.get(uid, f"user{uid}"), json.loads(body) if body else None
+        except (EOFError, gzip.BadGzipFile):
+            return
+
+
+# ---------------- Replay ----------------
+def delivery_key(message, origin):
+    """What ties a delivered message back to the one that caused it (None: not timed)."""
+    mtype = message.get('type')
+    if mtype in ('chat', 'private'):
+        return origin, 'text', message.get('message')
+    if mtype == 'call_data':
+        data = message.get('data')
+        return origin, 'media', data[:96] if isinstance(data, (str, bytes)) else None
+    if mtype in ('file', 'file_offer'):
+        return origin, 'file', message.get('filename')
+    if mtype in ('search_request', 'search_results'):
+        return origin, 'search', message.get('request_id')
+    return None
+
+class ReplayClient:
+    """One synthetic client: logs in like the captured user, times deliveries on a reader thread."""
+    def __init__(self, replay, port, username, features):
+        self.replay = replay
+        self.username = username
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        hello = json.dumps(make_hello(username, features)) if replay.hello else username
+        self.sock.sendall((hello + "\n").encode('utf-8'))
+        data = b""
+        while b"\n" not in data:
+            chunk = self.sock.recv(4096)
+            if not chunk: raise ConnectionError("server closed the connection")
+            data += chunk
+        line, leftover = data.split(b"\n", 1)
+        welcome = json.loads(line)
+        if welcome.get('type') != 'welcome': raise ConnectionError(welcome.get('message'))
+        self.wire = (welcome.get('framing', 'ndjson'), welcome.get('compression', 'none'), welcome.get('codec', 'json'))
+        self.send_lock = threading.Lock()
+        threading.Thread(target=self._read_loop, args=(leftover,), daemon=True).start()
+
+    def send(self, message):
+        frame = encode_frame(message, *self.wire)
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def close(self):
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        self.sock.close()
+
+    def _read_loop(self, data):
+        reader = FrameReader(self.wire[0], self.wire[2])
+        try:
+            while True:
+                for message in reader.feed(data):
+                    if message.get('type') == 'ping':  # heartbeat clients answer or get reaped
+                        self.send({'type': 'pong', 'id': message.get('id')})
+                        continue
+                    origin = self.username if message.get('type') == 'search_results' else message.get('sender')
+                    self.replay.delivered(delivery_key(message, origin))
+                data = self.sock.recv(1024 * 1024)
+                if not data: return
+        except (OSError, ValueError):
+            return
+
+class Replay:
+    def __init__(self, records, port, speed, hello=True):
+        self.records = records
+        self.port = port
+        self.speed = speed
+        self.hello = hello      # False: the server predates the hello and takes a bare username
+        self.clients = {}
+        self.sent_at = {}       # delivery key -> perf_counter of the latest send
+        self.latencies = {}     # 'text' / 'media' / 'file' / 'search' -> [seconds]
+        self.deliveries = 0
+        self.last_delivery = 0.0
+        self.lock = threading.Lock()
+        self.sent = self.skipped = 0
+        self.lag = []           # how far behind schedule each send went out
+
+    def delivered(self, key):
+        now = time.perf_counter()
+        with self.lock:
+            self.deliveries += 1
+            self.last_delivery = now
+            sent = self.sent_at.get(key) if key else None
+            if sent is not None:
+                self.latencies.setdefault(key[1], []).append(now - sent)
+
+    def run(self, drain=2.0):
+        start = time.perf_counter()
+        for kind, when, username, message in self.records:
+            if self.speed:
+                delay = start + when / self.speed - time.perf_counter()
+                if delay > 0: time.sleep(delay)
+                else: self.lag.append(-delay)
+            try:
+                if kind == TRACE_LOGIN:
+                    old = self.clients.pop(username, None)
+                    if old: old.close()
+                    self.clients[username] = ReplayClient(self, self.port, username, (message or {}).get('features', []))
+                elif kind == TRACE_LOGOUT:
+                    client = self.clients.pop(username, None)
+                    if client: client.close()
+                elif kind == TRACE_MESSAGE:
+                    client = self.clients.get(username)
+                    if client is None: self.skipped += 1; continue
+                    key = delivery_key(message, username)
+                    if key:
+                        with self.lock: self.sent_at[key] = time.perf_counter()
+                    client.send(message)
+                    self.sent += 1
+            except (OSError, ConnectionError) as e:
+                print(f"[REPLAY] {username}: {e}")
+                self.skipped += 1
+        sent_done = time.perf_counter()
+        # wait for the tail of deliveries: until nothing has arrived for `drain` seconds
+        while time.perf_counter() - max(self.last_delivery, sent_done) < drain:
+            time.sleep(0.05)
+        for client in list(self.clients.values()): client.close()
+        end = max(self.last_delivery, sent_done)
+        return self.report(end - start, sent_done - start)
+
+    def report(self, elapsed, send_elapsed):
+        all_latencies = sorted(lat for lats in self.latencies.values() for lat in lats)
+        def pct(values, p): return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else float('nan')
+        result = {'sent': self.sent, 'skipped': self.skipped, 'deliveries': self.deliveries,
+                  'elapsed_s': elapsed, 'send_rate': self.sent / send_elapsed if send_elapsed else 0.0,
+                  'delivery_rate': self.deliveries / elapsed if elapsed else 0.0,
+                  'p50_ms': pct(all_latencies, 0.5), 'p95_ms': pct(all_latencies, 0.95), 'p99_ms': pct(all_latencies, 0.99),
+                  'max_lag_ms': max(self.lag) * 1000 if self.lag else 0.0}
+        for family, lats in self.latencies.items():
+            lats.sort()
+            result[f"{family}_p50_ms"] = pct(lats, 0.5)
+        return result
+
+def start_server(script, *options):
+    """
+    Runs a Chat_Server.py (any version) on loopback; returns (process, port, speaks the hello).
+    A free port if the script takes --port, else LEGACY_PORT (which must be free).
+    """
+    with open(script, encoding='utf-8') as f: source = f.read()
+    argv = [arg for flag, value in SERVER_OPTIONS.items() if f"'{flag}'" in source for arg in (flag, value)]
+    if "'--port'" in source:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        argv += ['--port', str(port)]
+    else:
+        port = LEGACY_PORT
+        try: socket.create_connection(('127.0.0.1', port), timeout=1).close()
+        except OSError: pass
+        else: raise RuntimeError(f"{script} listens on port {port}, which is already in use")
+    proc = subprocess.Popen([sys.executable, script, *argv, *options],
+                            cwd=os.path.dirname(os.path.abspath(script)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(250):
+        try: socket.create_connection(('127.0.0.1', port)).close(); break
+        except OSError: time.sleep(0.02)
+    else:
+        proc.kill()
+        raise RuntimeError(f"{script} did not start")
+    time.sleep(0.2)
+    return proc, port, "'hello'" in source
+
+def replay_against(script, records, speed, drain):
+    proc, port, hello = start_server(script)
+    try:
+        return Replay(records, port, speed, hello).run(drain)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def print_results(results):
+    """results: [(label, report dict)]; the last column is the delta of the last run vs the first."""
+    keys = list(dict.fromkeys(k for _, r in results for k in r))
+    print(f"{'metric':<20}" + ''.join(f"{label:>16}" for label, _ in results) + ("   delta" if len(results) > 1 else ""))
+    for key in keys:
+        values = [r.get(key, float('nan')) for _, r in results]
+        row = f"{key:<20}" + ''.join(f"{v:>16.2f}" if isinstance(v, float) else f"{v:>16}" for v in values)
+        if len(values) > 1 and values[0] and values[0] == values[0] and values[-1] == values[-1]:
+            row += f"  {(values[-1] - values[0]) / values[0] * 100:+6.1f}%"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a captured trace against a fresh server")
+    parser.add_argument('trace', help="file written by Chat_Server.py --capture")
+    parser.add_argument('--speed', type=float, default=1.0, help="1 = captured pace, N = N times faster, 0 = as fast as possible")
+    parser.add_argument('--server', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Chat_Server.py'),
+                        help="server script to replay against (default: this tree's)")
+    parser.add_argument('--baseline', help="another Chat_Server.py to replay first, for a before/after comparison")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds without deliveries that end a run")
+    args = parser.parse_args()
+    records = list(read_trace(args.trace))
+    users = {r[2] for r in records}
+    print(f"{len(records)} records from {len(users)} users, {records[-1][1] if records else 0:.1f}s captured")
+    results = []
+    if args.baseline:
+        results.append(('baseline', replay_against(args.baseline, records, args.speed, args.drain)))
+    results.append(('candidate' if args.baseline else 'server', replay_against(args.server, records, args.speed, args.drain)))
+    print_results(results)
@@ -1,265 +1,2071 @@
-"""
-Real-Time Multi-User Chat Application Server (Updated for Group Calls & Message Reliability)
-
-- FIX: Chat and File messages now reliably broadcast to all connected clients (except the sender) 
-       when sent to a room, addressing the issue where some users didn't receive messages.
-- Handles group_call_request and forwards call_data to all room members.
-"""
-
-import socket
-import threading
-import json
-from datetime import datetime
-
-class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
-        self.host = host
-        self.port = port
-        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        # state
-        self.clients = {}         # username -> socket
-        self.clients_lock = threading.Lock()
-
-        # NOTE: Rooms state is kept, but chat/file routing now uses the global client list for reliability (see process_message)
-        self.rooms = {'General': []}  # room_name -> list of usernames
-        self.rooms_lock = threading.Lock()
-
-        # active_calls still tracks both private (user->peer) and group (room->set of users)
-        self.active_calls = {}
-
-    def start(self):
-        self.server_sock.bind((self.host, self.port))
-        self.server_sock.listen()
-        print(f"[SERVER] Listening on {self.host}:{self.port}")
-        try:
-            while True:
-                client_sock, addr = self.server_sock.accept()
-                thr = threading.Thread(target=self.handle_client, args=(client_sock, addr), daemon=True)
-                thr.start()
-        except KeyboardInterrupt:
-            print("[SERVER] Shutting down")
-        finally:
-            self.server_sock.close()
-
-    # ---------- sending helpers (unchanged) ----------
-    def send_json_to_sock(self, sock, data):
-        try:
-            payload = json.dumps(data) + "\n"
-            sock.send(payload.encode('utf-8'))
-        except Exception as e:
-            print("[SERVER] send_json_to_sock error:", e)
-
-    def send_to_client(self, username, data):
-        with self.clients_lock:
-            sock = self.clients.get(username)
-            if sock:
-                self.send_json_to_sock(sock, data)
-
-    def broadcast(self, data, exclude=None):
-        with self.clients_lock:
-            for uname, sock in list(self.clients.items()):
-                if uname == exclude:
-                    continue
-                self.send_json_to_sock(sock, data)
-
-    def broadcast_to_room(self, room, data, exclude=None):
-        # NOTE: This method is now only used for Group Call Signaling and End Call notifications,
-        # where explicit room membership (active_calls[room] or self.rooms[room]) is needed.
-        with self.rooms_lock:
-            users = list(self.rooms.get(room, []))
-        for uname in users:
-            if uname == exclude:
-                continue
-            self.send_to_client(uname, data)
-
-    def broadcast_client_list(self):
-        with self.clients_lock:
-            clients = list(self.clients.keys())
-        self.broadcast({'type':'client_list','clients':clients})
-
-    # ---------- main connection handler (unchanged logic) ----------
-    def handle_client(self, client_sock, addr):
-        username = None
-        try:
-            # initial username (raw, not JSON)
-            data = client_sock.recv(4096)
-            if not data: client_sock.close(); return
-            username = data.decode('utf-8').strip()
-            if not username: client_sock.close(); return
-
-            with self.clients_lock:
-                if username in self.clients:
-                    self.send_json_to_sock(client_sock, {'type':'error','message':'Username taken'})
-                    client_sock.close(); return
-                self.clients[username] = client_sock
-
-            with self.rooms_lock:
-                if 'General' not in self.rooms: self.rooms['General'] = []
-                if username not in self.rooms['General']: self.rooms['General'].append(username)
-
-            print(f"[SERVER] {username} connected from {addr}")
-            self.send_json_to_sock(client_sock, {'type':'welcome','message':f'Welcome {username}','rooms': list(self.rooms.keys())})
-            self.broadcast({'type':'user_joined','username':username,'timestamp':datetime.now().strftime('%H:%M:%S')}, exclude=username)
-            self.broadcast_client_list()
-
-            buffer = ""
-            decoder = json.JSONDecoder()
-            while True:
-                chunk = client_sock.recv(1024*1024)
-                if not chunk: break
-                buffer += chunk.decode('utf-8', errors='ignore')
-                while buffer:
-                    buffer = buffer.lstrip()
-                    try:
-                        obj, idx = decoder.raw_decode(buffer)
-                        buffer = buffer[idx:]
-                        self.process_message(username, obj)
-                    except ValueError: break
-        except Exception as e:
-            print("[SERVER] handle_client error for", username, e)
-        finally:
-            self.disconnect(username)
-
-    # ---------- message routing (FIXED for Chat/File Reliability) ----------
-    def process_message(self, sender, message):
-        mtype = message.get('type')
-        if mtype == 'chat':
-            room = message.get('room','General')
-            payload = {'type':'chat','sender': sender,'message': message.get('message'),'room': room,'timestamp': datetime.now().strftime('%H:%M:%S')}
-            
-            # FIX: Use global broadcast for general chat messages. Client filters by current_room.
-            self.broadcast(payload, exclude=sender) 
-            
-        elif mtype == 'private':
-            recipient = message.get('recipient')
-            payload = {'type':'private','sender': sender,'message': message.get('message'),'timestamp': datetime.now().strftime('%H:%M:%S')}
-            self.send_to_client(recipient, payload)
-            
-        elif mtype == 'file':
-            recipient = message.get('recipient')
-            payload = {'type':'file','sender': sender,'filename': message.get('filename'),'filedata': message.get('filedata'),'filetype': message.get('filetype'),'timestamp': datetime.now().strftime('%H:%M:%S')}
-            if recipient: 
-                self.send_to_client(recipient, payload)
-            else: 
-                # FIX: Use global broadcast for room file messages too.
-                self.broadcast(payload, exclude=sender)
-                
-        elif mtype == 'create_room':
-            room_name = message.get('room_name')
-            with self.rooms_lock:
-                if room_name not in self.rooms: 
-                    # Add all current clients to the room's user list for call purposes
-                    self.rooms[room_name] = list(self.clients.keys()) 
-            self.broadcast({'type':'room_created','room_name':room_name,'creator':sender})
-        
-        # --- PRIVATE CALL SIGNALING ---
-        elif mtype == 'call_request':
-            recipient = message.get('recipient')
-            self.send_to_client(recipient, {'type':'call_request','caller':sender,'call_type':message.get('call_type'),'timestamp': datetime.now().strftime('%H:%M:%S')})
-        elif mtype == 'call_response':
-            caller = message.get('caller')
-            accepted = message.get('accepted')
-            call_type = message.get('call_type','both')
-            if accepted:
-                self.active_calls[sender] = caller
-                self.active_calls[caller] = sender
-            self.send_to_client(caller, {'type':'call_response','responder':sender,'accepted':accepted,'call_type':call_type})
-
-        # --- GROUP CALL SIGNALING ---
-        elif mtype == 'group_call_request':
-            room = message.get('room')
-            call_type = message.get('call_type','video')
-            with self.rooms_lock:
-                if room not in self.rooms: return
-            
-            if room not in self.active_calls: self.active_calls[room] = set()
-            self.active_calls[room].add(sender)
-            
-            # Broadcast request to all room members (excluding the caller)
-            self.broadcast_to_room(room, {
-                'type':'group_call_request',
-                'room':room,
-                'caller':sender,
-                'call_type':call_type,
-                'timestamp': datetime.now().strftime('%H:%M:%S')
-            }, exclude=sender)
-
-        # --- MEDIA DATA FORWARDING ---
-        elif mtype == 'call_data':
-            if 'peer' in message: # Private Call Data
-                peer = message.get('peer')
-                payload = {'type':'call_data','sender':sender,'data': message.get('data'),'data_type': message.get('data_type')}
-                self.send_to_client(peer, payload)
-            
-            elif 'room' in message: # Group Call Data
-                room = message.get('room')
-                if room in self.active_calls and isinstance(self.active_calls[room], set):
-                    # Forward to all active call members in the room (excluding sender)
-                    for user in list(self.active_calls[room]):
-                        if user != sender:
-                            payload = {'type':'call_data','sender':sender,'data': message.get('data'),'data_type': message.get('data_type')}
-                            self.send_to_client(user, payload)
-            else:
-                print("[SERVER] Invalid call_data payload (missing peer/room)")
-
-
-        # --- END CALL ---
-        elif mtype == 'end_call':
-            is_group = message.get('is_group', False)
-            
-            if is_group:
-                room = message.get('room')
-                if room in self.active_calls and isinstance(self.active_calls[room], set):
-                    self.active_calls[room].discard(sender)
-                    if not self.active_calls[room]:
-                        self.active_calls.pop(room, None)
-                        self.broadcast_to_room(room, {'type':'call_ended','peer':room}) # Notify room call is over
-                self.send_to_client(sender, {'type':'call_ended','peer':room}) # Self-confirmation
-                
-            else: # Private Call
-                if sender in self.active_calls:
-                    peer = self.active_calls.pop(sender, None)
-                    if peer and peer in self.active_calls:
-                        self.active_calls.pop(peer, None)
-                        self.send_to_client(peer, {'type':'call_ended','peer':sender})
-                self.send_to_client(sender, {'type':'call_ended','peer':sender})
-
-        else:
-            print("[SERVER] Unknown message type from", sender, mtype)
-
-    def disconnect(self, username):
-        if not username: return
-        with self.clients_lock:
-            sock = self.clients.pop(username, None)
-            if sock:
-                try: sock.close()
-                except: pass
-        with self.rooms_lock:
-            for room, users in self.rooms.items():
-                if username in users: users.remove(username)
-        
-        # End any active private call
-        if username in self.active_calls:
-            peer = self.active_calls.pop(username, None)
-            if peer and peer in self.active_calls:
-                self.active_calls.pop(peer, None)
-                self.send_to_client(peer, {'type':'call_ended','peer':username})
-
-        # End any active group calls the user was in
-        rooms_to_check = list(self.active_calls.keys())
-        for room in rooms_to_check:
-            if isinstance(self.active_calls.get(room), set) and username in self.active_calls[room]:
-                 self.active_calls[room].discard(username)
-                 if not self.active_calls[room]:
-                    self.active_calls.pop(room, None)
-                    self.broadcast_to_room(room, {'type':'call_ended','peer':room})
-
-        print(f"[SERVER] {username} disconnected")
-        self.broadcast({'type':'user_left','username':username,'timestamp':datetime.now().strftime('%H:%M:%S')})
-        self.broadcast_client_list()
-
-if __name__ == '__main__':
-    server = ChatServer(host='0.0.0.0', port=5555)   
+"""
+Real-Time Multi-User Chat Application Server (Updated for Group Calls & Message Reliability)
+
+- Room chat and files go to the room's members (clients without the room directory still get
+  every room, as they always did); private ones to their recipient.
+- Handles group_call_request and forwards call_data to all room members.
+- Structured hello/welcome handshake (see Chat_Protocol.py) with accept-side admission control.
+- Optional TLS (--tls-cert/--tls-key), handshaken in the handshake pool; call media may use a
+  separate plaintext connection where policy allows (--plain-media).
+- Zero-downtime restarts (--handoff PATH): a new process started with the same PATH takes over
+  the listening socket (fd passing over a Unix socket) and the sessions, rooms, calls and search
+  index of the running one, which drains its clients and exits. See ChatServer.hand_over.
+- Dead peers are reaped: clients with the 'heartbeat' feature are pinged when quiet and
+  dropped after HEARTBEAT_MISSES silent intervals; TCP keepalive catches everyone else.
+- With --p2p-files, private files can go directly between clients: the server only brokers
+  the transfer (endpoints and a one-time token, see broker_transfer) and never sees the bytes.
+- On-demand profiling (--admin PATH, then python Chat_Profiler.py PATH): per-handler timing,
+  stack samples and allocation growth for N seconds, optionally per-stage message spans.
+"""
+
+import socket
+import ssl
+import threading
+import json
+import time
+import argparse
+import base64
+import io
+import os
+import wave
+import zlib
+import tempfile
+import secrets
+import signal
+import re
+import bisect
+import heapq
+import struct
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from itertools import islice
+from datetime import datetime
+from collections import deque
+try:
+    from PIL import Image  # optional: image thumbnails
+except ImportError:
+    Image = None
+from Chat_Protocol import (CODECS, CallData, FrameReader, ProtocolError, encode_frame, fragment_frame, negotiate, seq_prefix,
+                           set_keepalive, tune_socket, CHUNK_SIZE, HEARTBEAT_MISSES, MEDIA_PLAIN, MEDIA_TRANSPORTS,
+                           P2P_MAX_BYTES, SOCKET_CLASSES)
+from Chat_Profiler import PROFILE_FOLDER, PROFILE_MAX_SECONDS, PROFILE_SAMPLE_RATE, PROFILE_SECONDS, Profiler
+from Chat_Replay import TRACE_LOGIN, TRACE_LOGOUT, TRACE_MESSAGE, TraceWriter
+
+# Presence settings
+PRESENCE_TICK = 0.25  # seconds; joins/leaves inside one tick go out as a single delta
+
+# Admission control (accept side)
+LISTEN_BACKLOG = 1024
+CONNECT_RATE = 200.0        # new connections admitted per second (token bucket refill)
+CONNECT_BURST = 500         # token bucket size
+MAX_PENDING_HANDSHAKES = 256
+HANDSHAKE_WORKERS = 16
+HANDSHAKE_TIMEOUT = 5.0     # seconds a client gets to send its hello
+MAX_HELLO_SIZE = 64 * 1024
+RETRY_AFTER = 2.0           # hint sent to rejected clients (seconds)
+ACCEPT_POLL = 0.5           # accept() timeout, so the accept loop notices a handoff
+
+# Restart handoff (--handoff): Unix socket control channel between the old and the new process
+HANDOFF_REQUEST = b'chat-handoff-1\n'
+HANDOFF_ACK = b'chat-handoff-ok\n'
+HANDOFF_HEADER = struct.Struct('!Q')  # length of the compressed state that follows the fd
+HANDOFF_DRAIN_TIMEOUT = 2.0           # seconds resumable clients get to disconnect after 'server_restart'
+HANDOFF_ACK_TIMEOUT = 30.0            # for the new process to load the state
+HANDOFF_MAX_SOCKETS = 64              # connections accepted mid-handoff, passed on unhandshaken
+
+# Admin socket (--admin): one JSON command per connection, see _admin_command
+ADMIN_MAX_REQUEST = 4096
+
+# TLS
+TLS_MIN_VERSION = ssl.TLSVersion.TLSv1_2
+TLS_TICKETS = 2             # TLS 1.3 session tickets per full handshake; reconnects resume with one
+TLS_RECORD_BYTE = b'\x16'   # first byte of a TLS ClientHello (plaintext on a TLS port must be media)
+
+# Calls
+ACTIVE_SPEAKER_HOLD = 0.6   # seconds the active speaker keeps the floor after their last voiced packet
+
+SERVER_FEATURES = ('presence', 'resume', 'previews', 'voice_stream', 'heartbeat', 'p2p_files', 'room_directory')  # optional protocol features this server can negotiate
+
+# Heartbeats / idle reaping (see Chat_Protocol.py)
+HEARTBEAT_INTERVAL = 15.0   # seconds a 'heartbeat' client may be quiet before it is pinged (0: off)
+HEARTBEAT_TICK = 1.0        # reaper resolution (at most; a quarter interval for short intervals)
+HEARTBEAT_RTT_SAMPLES = 1024
+HEARTBEAT_REPORT = 300.0    # seconds between heartbeat metrics log lines (only when something changed)
+
+# Session resumption
+SESSION_GRACE = 60.0                   # seconds a dropped session waits for its client to resume
+SESSION_REPLAY_SIZE = 1000             # messages kept per session for replay
+SESSION_REPLAY_BYTES = 32 * 1024 * 1024
+REPLAYABLE = ('chat', 'private', 'file', 'file_offer', 'room_created')  # sequenced and replayed after resume
+
+# Brokered peer-to-peer file transfer (--p2p-files): endpoints and a token per transfer, never the bytes
+P2P_TRANSFER_TIMEOUT = 120.0  # seconds a brokered transfer has to report back before it is forgotten
+P2P_MAX_PENDING = 8           # brokered transfers per sender at once
+
+# Room directory ('room_directory' clients browse rooms instead of being sent every one)
+ROOM_PAGE_SIZE = 50
+ROOM_MAX_PAGE_SIZE = 200
+ROOM_NAME_MAX = 64
+
+# Search
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_MAX_EXPANSIONS = 200  # vocabulary terms a single prefix may expand to
+TOKEN_RE = re.compile(r"\w+")
+INDEX_MAX_CHARS = 8192       # only the head of very long messages is indexed
+INDEX_MAX_TOKEN = 40         # longer "words" (base64 blobs, hashes) are not indexed
+INDEX_MAX_MESSAGES = 1_000_000  # newest messages kept searchable; older ones are evicted
+VOCAB_CHUNK = 512            # vocabulary chunk size: a new token shifts at most 2x this many
+
+# File previews ('previews' clients get a small preview first and fetch the file on demand)
+PREVIEW_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+IMAGE_TYPES = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+THUMBNAIL_SIZE = (160, 160)
+THUMBNAIL_QUALITY = 60
+WAVEFORM_BUCKETS = 48
+FILE_STORE_BYTES = 512 * 1024 * 1024  # uploads kept for on-demand fetch (LRU)
+
+# Streamed voice messages ('voice_start' / 'voice_chunk' / 'voice_end')
+VOICE_MAX_BYTES = 20 * 1024 * 1024   # decoded PCM per message
+VOICE_MAX_STREAMS = 2                # concurrent uploads per user
+VOICE_SPOOL_BYTES = 1024 * 1024      # in memory up to this, then spilled to a temp file
+
+# Outbound priority lanes (lower value is sent first)
+LANE_CONTROL, LANE_AUDIO, LANE_CHAT, LANE_VIDEO, LANE_BULK = range(5)
+
+# Write coalescing: queued frames go out together in one sendmsg (writev) call
+COALESCE_BYTES = 64 * 1024   # per call; at most one file fragment, so a file can't hog a write
+COALESCE_FRAMES = 64         # wire buffers per call (well under IOV_MAX)
+FLUSH_WINDOW = 0.0           # seconds an idle writer waits for a burst to gather (never for audio); 0: batches
+                             # are what queued during the previous write (a wait cost ~0.8 ms p50 for ~20% fewer sends)
+
+# Slow-consumer policy, by bytes queued for one client
+SHED_VIDEO_BYTES = 1 * 1024 * 1024      # above this, new video frames are dropped
+THROTTLE_FILE_BYTES = 4 * 1024 * 1024   # above this, file frames are parked until the backlog drains
+DISCONNECT_BYTES = 64 * 1024 * 1024     # above this (parked file frames included), the client is disconnected
+
+def lane_for(data):
+    mtype = data.get('type')
+    if mtype == 'call_data':
+        return LANE_AUDIO if data.get('data_type') in ('audio', 'comfort_noise') else LANE_VIDEO
+    if mtype in ('chat', 'private'): return LANE_CHAT
+    if mtype == 'file': return LANE_BULK
+    if mtype == 'file_offer': return LANE_CHAT
+    return LANE_CONTROL
+
+class SlowConsumerPolicy:
+    def __init__(self, shed_video_bytes=SHED_VIDEO_BYTES, throttle_file_bytes=THROTTLE_FILE_BYTES,
+                 disconnect_bytes=DISCONNECT_BYTES):
+        self.shed_video_bytes = shed_video_bytes
+        self.throttle_file_bytes = throttle_file_bytes
+        self.disconnect_bytes = disconnect_bytes
+
+def make_tls_context(certfile, keyfile=None):
+    """Server TLS context. Session tickets are on, so reconnecting clients skip the full handshake."""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = TLS_MIN_VERSION
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = TLS_TICKETS
+    return context
+
+class HeartbeatStats:
+    """Reaped connections and ping round-trip times; written by reader threads, so locked."""
+    def __init__(self, samples=HEARTBEAT_RTT_SAMPLES):
+        self.lock = threading.Lock()
+        self.pings = self.pongs = 0
+        self.reaped = 0            # silent past the heartbeat timeout
+        self.reaped_keepalive = 0  # reset by the kernel (TCP keepalive / user timeout)
+        self.rtt = deque(maxlen=samples)  # seconds, most recent pongs
+
+    def count(self, field):
+        with self.lock: setattr(self, field, getattr(self, field) + 1)
+
+    def pong(self, rtt):
+        with self.lock:
+            self.pongs += 1
+            self.rtt.append(rtt)
+
+    def snapshot(self):
+        with self.lock:
+            rtt = sorted(self.rtt)
+            result = {'pings': self.pings, 'pongs': self.pongs, 'reaped': self.reaped,
+                      'reaped_keepalive': self.reaped_keepalive}
+        def pct(p): return rtt[min(len(rtt) - 1, int(len(rtt) * p))] * 1000 if rtt else None
+        result.update(rtt_p50_ms=pct(0.5), rtt_p95_ms=pct(0.95), rtt_max_ms=rtt[-1] * 1000 if rtt else None)
+        return result
+
+class WriteStats:
+    """Frames and send calls of closed connections (live ones keep their own counters)."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = self.writes = 0
+
+    def add(self, frames, writes):
+        with self.lock:
+            self.frames += frames
+            self.writes += writes
+
+class TokenBucket:
+    """Connect-rate limiter; only touched by the accept thread, so no lock."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+# ---------- preview workers (run in a process pool; must stay module-level) ----------
+def make_image_thumbnail(filedata):
+    img = Image.open(io.BytesIO(base64.b64decode(filedata)))
+    img.thumbnail(THUMBNAIL_SIZE)
+    if img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    return {'kind':'image','width':img.width,'height':img.height,
+            'thumbnail':base64.b64encode(out.getvalue()).decode('utf-8')}
+
+def make_wav_summary(filedata):
+    with wave.open(io.BytesIO(base64.b64decode(filedata)), 'rb') as wf:
+        channels, width, rate, nframes = wf.getnchannels(), wf.getsampwidth(), wf.getframerate(), wf.getnframes()
+        raw = wf.readframes(nframes)
+    peaks = []
+    if width == 2 and nframes:
+        samples = array('h', raw[:len(raw) // 2 * 2])
+        step = max(1, len(samples) // WAVEFORM_BUCKETS)
+        for i in range(0, len(samples), step):
+            bucket = samples[i:i + step]
+            peaks.append(round(max(max(bucket), -min(bucket)) / 32768, 3))
+    return {'kind':'audio','duration':round(nframes / float(rate), 2) if rate else 0,
+            'channels':channels,'rate':rate,'waveform':peaks[:WAVEFORM_BUCKETS]}
+
+def preview_job(filetype):
+    filetype = (filetype or '').lower()
+    if filetype in IMAGE_TYPES: return make_image_thumbnail if Image is not None else None
+    if filetype == '.wav': return make_wav_summary
+    return None
+
+class VoiceUpload:
+    """A voice message arriving in chunks while the sender is still recording."""
+    def __init__(self, sender, message):
+        self.sender = sender
+        self.recipient = message.get('recipient')
+        self.room = message.get('room')
+        self.filename = os.path.basename(str(message.get('filename') or 'voice_msg.wav'))
+        self.rate = int(message.get('rate', 44100))
+        self.channels = int(message.get('channels', 1))
+        self.sample_width = int(message.get('sample_width', 2))
+        if not (8000 <= self.rate <= 192000 and 1 <= self.channels <= 2 and self.sample_width in (1, 2, 3, 4)):
+            raise ValueError("unsupported audio format")
+        codec = message.get('codec', 'pcm')
+        if codec not in ('pcm', 'zlib'): raise ValueError(f"unknown codec {codec}")
+        self.decompressor = zlib.decompressobj() if codec == 'zlib' else None
+        self.pcm = tempfile.SpooledTemporaryFile(max_size=VOICE_SPOOL_BYTES)
+        self.size = 0
+        self.next_seq = 0
+
+    def add(self, seq, data):
+        if seq != self.next_seq: raise ValueError(f"chunk {seq} out of order (expected {self.next_seq})")
+        self.next_seq += 1
+        raw = base64.b64decode(data or '')
+        if self.decompressor:
+            raw = self.decompressor.decompress(raw, VOICE_MAX_BYTES - self.size + 1)
+        self.size += len(raw)
+        if self.size > VOICE_MAX_BYTES: raise ValueError("voice message too large")
+        self.pcm.write(raw)
+
+    def finish(self):
+        """Returns the complete WAV file, base64-encoded like a regular 'file' upload."""
+        out = io.BytesIO()
+        with wave.open(out, 'wb') as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(self.sample_width)
+            wf.setframerate(self.rate)
+            self.pcm.seek(0)
+            while True:
+                block = self.pcm.read(1024 * 1024)
+                if not block: break
+                wf.writeframes(block)
+        self.pcm.close()
+        return base64.b64encode(out.getvalue()).decode('utf-8')
+
+    def close(self):
+        self.pcm.close()
+
+class FileStore:
+    """Bounded LRU of uploaded files kept for on-demand 'file_fetch'."""
+    def __init__(self, max_bytes=FILE_STORE_BYTES):
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()  # file_id -> (payload, usernames that may fetch it, or None for everyone)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def put(self, payload, audience=None):
+        file_id = secrets.token_hex(8)
+        with self.lock:
+            self.files[file_id] = (payload, audience)
+            self.size += len(payload.get('filedata') or '')
+            while self.size > self.max_bytes and len(self.files) > 1:
+                _, (old, _) = self.files.popitem(last=False)
+                self.size -= len(old.get('filedata') or '')
+        return file_id
+
+    def get(self, file_id, username):
+        with self.lock:
+            entry = self.files.get(file_id)
+            if not entry: return None
+            self.files.move_to_end(file_id)
+        payload, audience = entry
+        if audience is not None and username not in audience: return None
+        return payload
+
+class CallSession:
+    """One private (room None) or group call. `members` is replaced, never mutated."""
+    __slots__ = ('call_id', 'room', 'members', 'speaker', 'voiced')
+    def __init__(self, room=None):
+        self.call_id = secrets.token_hex(6)
+        self.room = room
+        self.members = {}  # username -> ClientConnection
+        self.speaker = None
+        self.voiced = {}   # username -> monotonic time of their last voiced audio packet
+
+class CallManager:
+    """
+    Active calls, indexed by call id, by user (one call each) and by room (its group call).
+
+    Membership changes are rare: they take the lock and rebuild, for every member of the
+    call, an immutable tuple of the other members' connections. Forwarding a media packet
+    is frequent: routes_for() is one lock-free dict lookup. After a restart handoff a
+    member's connection is None until its client resumes (see rebind).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_id = {}
+        self.by_user = {}
+        self.by_room = {}
+        self.routes = {}   # username -> tuple of recipient ClientConnections
+
+    def _set_members(self, call, members):
+        # Caller holds self.lock
+        call.members = members
+        for username in members:
+            self.routes[username] = tuple(c for u, c in members.items() if u != username and c is not None)
+
+    def routes_for(self, username):
+        return self.routes.get(username, ())
+
+    def call_of(self, username):
+        return self.by_user.get(username)
+
+    def start_private(self, a, conn_a, b, conn_b):
+        """Both users must have left any previous call (see ChatServer.end_calls)."""
+        call = CallSession()
+        with self.lock:
+            self.by_id[call.call_id] = call
+            self.by_user[a] = self.by_user[b] = call
+            self._set_members(call, {a: conn_a, b: conn_b})
+        return call
+
+    def join_group(self, room, username, conn, create=True):
+        """Adds username to the room's call (starting it if create). Returns the call or None."""
+        with self.lock:
+            call = self.by_room.get(room)
+            if call is None:
+                if not create: return None
+                call = CallSession(room)
+                self.by_id[call.call_id] = self.by_room[room] = call
+            if username not in call.members:
+                self.by_user[username] = call
+                self._set_members(call, {**call.members, username: conn})
+        return call
+
+    def rebind(self, username, conn):
+        """Points username's call membership (if any) at a new connection."""
+        with self.lock:
+            call = self.by_user.get(username)
+            if call is not None:
+                self._set_members(call, {**call.members, username: conn})
+
+    def export(self, usernames):
+        """[{'room', 'members'}] for calls with at least one member in usernames."""
+        with self.lock:
+            calls = [{'room': call.room, 'members': [u for u in call.members if u in usernames]}
+                     for call in self.by_id.values()]
+        return [c for c in calls if c['members']]
+
+    def restore(self, room, members):
+        call = CallSession(room)
+        with self.lock:
+            self.by_id[call.call_id] = call
+            if room is not None: self.by_room[room] = call
+            for username in members: self.by_user[username] = call
+            self._set_members(call, dict.fromkeys(members))
+        return call
+
+    def leave(self, username):
+        """
+        Takes username out of its call. Returns None if it wasn't in one, else
+        (call, remaining usernames, ended): a private call ends when either side leaves,
+        a group call when its last member does.
+        """
+        with self.lock:
+            call = self.by_user.pop(username, None)
+            if call is None: return None
+            self.routes.pop(username, None)
+            call.voiced.pop(username, None)
+            if call.speaker == username: call.speaker = None
+            members = {u: c for u, c in call.members.items() if u != username}
+            ended = call.room is None or not members
+            if ended:
+                for u in members:
+                    self.by_user.pop(u, None)
+                    self.routes.pop(u, None)
+                self.by_id.pop(call.call_id, None)
+                if call.room is not None: self.by_room.pop(call.room, None)
+                call.members = {}
+            else:
+                self._set_members(call, members)
+        return call, list(members), ended
+
+class Session:
+    """
+    Per-user state that outlives one TCP connection (clients with the 'resume' feature).
+
+    Replayable messages get a per-session sequence number and are kept in a bounded ring
+    buffer; a reconnecting client presents its token and last-seen sequence number and
+    gets only what it missed. While detached, messages are buffered but not sent.
+    """
+    def __init__(self, username, wire, features=()):
+        self.username = username
+        self.token = secrets.token_urlsafe(24)
+        self.wire = wire
+        self.features = set(features)
+        self.conn = None
+        self.detached_at = None
+        self.next_seq = 1
+        self.replay = deque()   # (seq, lane, frame, wire)
+        self.replay_bytes = 0
+        self.lock = threading.Lock()
+
+    def deliver(self, data, frame=None, lane=None):
+        if lane is None: lane = lane_for(data)
+        with self.lock:
+            conn = self.conn
+            wire = conn.wire if conn else self.wire
+            if frame is None or (conn and frame[1] != wire):
+                frame = (ClientConnection.encode(data, *wire), wire)
+            seq = None
+            if data.get('type') in REPLAYABLE:
+                seq = self.next_seq
+                self.next_seq += 1
+                self.replay.append((seq, lane, frame[0], frame[1]))
+                self.replay_bytes += len(frame[0])
+                while len(self.replay) > SESSION_REPLAY_SIZE or self.replay_bytes > SESSION_REPLAY_BYTES:
+                    self.replay_bytes -= len(self.replay.popleft()[2])
+            if conn:
+                conn.send_frame(frame[0], lane, seq)
+
+    def export(self):
+        """JSON-able state for a restart handoff (see ChatServer.export_state)."""
+        with self.lock:
+            return {'username': self.username, 'token': self.token, 'wire': list(self.wire),
+                    'features': sorted(self.features), 'next_seq': self.next_seq,
+                    'replay': [[seq, lane, base64.b64encode(frame).decode('ascii'), list(wire)]
+                               for seq, lane, frame, wire in self.replay]}
+
+    @classmethod
+    def restore(cls, state):
+        """A handed-over session, detached until its client resumes."""
+        session = cls(state['username'], tuple(state['wire']), state['features'])
+        session.token = state['token']
+        session.next_seq = state['next_seq']
+        for seq, lane, frame, wire in state['replay']:
+            frame = base64.b64decode(frame)
+            session.replay.append((seq, lane, frame, tuple(wire)))
+            session.replay_bytes += len(frame)
+        session.detached_at = time.monotonic()
+        return session
+
+    def attach(self, conn, last_seq):
+        """Returns False if messages after last_seq have already been evicted."""
+        with self.lock:
+            self.conn = conn
+            self.wire = conn.wire
+            self.detached_at = None
+            complete = not self.replay or self.replay[0][0] <= last_seq + 1
+            for seq, lane, frame, wire in self.replay:
+                if seq <= last_seq: continue
+                if wire != conn.wire:
+                    frame = ClientConnection.encode(FrameReader(wire[0], wire[2]).feed(frame)[0], *conn.wire)
+                conn.send_frame(frame, lane, seq)
+            return complete
+
+    def detach(self, conn):
+        with self.lock:
+            if self.conn is not conn: return False
+            self.conn = None
+            self.detached_at = time.monotonic()
+            return True
+
+class Vocabulary:
+    """
+    Sorted token set kept in chunks of up to 2 * VOCAB_CHUNK: a new token shifts one chunk,
+    not the whole vocabulary, and prefix lookups bisect the chunk maxima then the chunk.
+    """
+    def __init__(self):
+        self.chunks = []  # sorted lists, each after the previous
+        self.maxes = []   # last token of each chunk
+
+    def add(self, tok):
+        if not self.chunks:
+            self.chunks.append([tok]); self.maxes.append(tok)
+            return
+        i = min(bisect.bisect_left(self.maxes, tok), len(self.maxes) - 1)
+        chunk = self.chunks[i]
+        bisect.insort(chunk, tok)
+        self.maxes[i] = chunk[-1]
+        if len(chunk) > 2 * VOCAB_CHUNK:
+            self.chunks[i:i + 1] = [chunk[:VOCAB_CHUNK], chunk[VOCAB_CHUNK:]]
+            self.maxes[i:i + 1] = [chunk[VOCAB_CHUNK - 1], chunk[-1]]
+
+    def discard(self, tok):
+        i = bisect.bisect_left(self.maxes, tok)
+        if i == len(self.chunks): return
+        chunk = self.chunks[i]
+        j = bisect.bisect_left(chunk, tok)
+        if j == len(chunk) or chunk[j] != tok: return
+        del chunk[j]
+        if chunk: self.maxes[i] = chunk[-1]
+        else: del self.chunks[i], self.maxes[i]
+
+    def prefixed(self, prefix):
+        """Tokens starting with prefix, in order."""
+        i = bisect.bisect_left(self.maxes, prefix)
+        start = bisect.bisect_left(self.chunks[i], prefix) if i < len(self.chunks) else 0
+        for chunk in self.chunks[i:]:
+            for tok in islice(chunk, start, None):
+                if not tok.startswith(prefix): return
+                yield tok
+            start = 0
+
+class MessageIndex:
+    """
+    Incremental inverted index over room and private messages, for 'search_request'.
+
+    Messages are append-only and arrive in time order, so doc ids, posting lists and the
+    timestamp array are all ascending: time ranges become bisect slices. Query terms are
+    prefixes, expanded through a sorted vocabulary. Rooms/senders are interned and have
+    posting lists of their own; a private conversation is the scope '@a|b' (names sorted)
+    and is only searchable by a or b; search(rooms=) limits rooms to the requester's.
+
+    Only the newest max_messages are kept. Past that the oldest are evicted in a batch (1/64
+    of the cap) and cut off the front of their posting lists; doc ids keep counting, offset
+    by first. A search reaching back before the newest evicted message (horizon) reports
+    its total as inexact.
+
+    A search walks the rarest list (term or filter) newest first and checks each doc against
+    the others by bisect, so it stops as soon as a page of best-scoring hits is found: the
+    total is then an estimate, extrapolated from the share of the rarest list scanned.
+    """
+    def __init__(self, max_messages=INDEX_MAX_MESSAGES):
+        self.lock = threading.Lock()
+        self.max_messages = max_messages
+        self.low_water = max_messages - max_messages // 64  # eviction trims down to this
+        self.first = 0           # doc id of the oldest kept message (times[0], texts[0], ...)
+        self.horizon = 0         # time of the newest evicted message (0: nothing evicted)
+        self.names = []          # interned room/scope/sender names
+        self.name_ids = {}
+        self.times = array('d')
+        self.senders = array('I')
+        self.scopes = array('I')
+        self.texts = []
+        self.postings = {}       # token -> array('I') of doc ids
+        self.scope_docs = {}     # scope id -> array('I') of doc ids
+        self.sender_docs = {}    # sender id -> array('I') of doc ids
+        self.vocab = Vocabulary()
+
+    def _intern(self, name):
+        nid = self.name_ids.get(name)
+        if nid is None:
+            nid = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return nid
+
+    @staticmethod
+    def private_scope(a, b):
+        return '@' + '|'.join(sorted((a, b)))
+
+    @staticmethod
+    def _tokens(text):
+        return {tok for tok in TOKEN_RE.findall(str(text)[:INDEX_MAX_CHARS].lower()) if len(tok) <= INDEX_MAX_TOKEN}
+
+    def add(self, scope, sender, text, when=None):
+        tokens = self._tokens(text)
+        with self.lock:
+            doc = self.first + len(self.texts)
+            sender_id, scope_id = self._intern(sender), self._intern(scope)
+            self.times.append(when or time.time())
+            self.senders.append(sender_id)
+            self.scopes.append(scope_id)
+            self.texts.append(text)
+            self.sender_docs.setdefault(sender_id, array('I')).append(doc)
+            self.scope_docs.setdefault(scope_id, array('I')).append(doc)
+            for tok in tokens:
+                plist = self.postings.get(tok)
+                if plist is None:
+                    plist = self.postings[tok] = array('I')
+                    self.vocab.add(tok)
+                plist.append(doc)
+            if len(self.texts) > self.max_messages: self._evict(len(self.texts) - self.low_water)
+
+    def _evict(self, count):
+        """Drops the count oldest messages (lock held), and posting lists left empty."""
+        first = self.first + count
+        def trim(table, key):
+            plist = table.get(key)
+            if plist is None or plist[0] >= first: return  # already trimmed past this batch
+            del plist[:bisect.bisect_left(plist, first)]
+            if not plist:
+                del table[key]
+                return True
+        for text in self.texts[:count]:
+            for tok in self._tokens(text):
+                if trim(self.postings, tok): self.vocab.discard(tok)
+        for table, ids in ((self.scope_docs, self.scopes), (self.sender_docs, self.senders)):
+            for nid in set(ids[:count]): trim(table, nid)
+        self.horizon = self.times[count - 1]
+        for column in (self.times, self.senders, self.scopes, self.texts): del column[:count]
+        self.first = first
+
+    def export(self):
+        with self.lock:
+            return [[self.times[i], self.names[self.scopes[i]], self.names[self.senders[i]], self.texts[i]]
+                    for i in range(len(self.texts))]
+
+    @staticmethod
+    def _contains(plist, doc):
+        i = bisect.bisect_left(plist, doc)
+        return i < len(plist) and plist[i] == doc
+
+    @staticmethod
+    def _newest_first(slices):
+        """Doc ids of (plist, start, end) slices, descending (a doc in several slices repeats)."""
+        descending = [map(plist.__getitem__, range(end - 1, start - 1, -1)) for plist, start, end in slices]
+        return descending[0] if len(descending) == 1 else heapq.merge(*descending, reverse=True)
+
+    def search(self, query, requester, rooms=None, scope=None, sender=None, since=None, until=None,
+               offset=0, limit=SEARCH_PAGE_SIZE):
+        """Returns (total, page of results, whether total is exact). rooms: the rooms requester may read (None: all)."""
+        terms = list(dict.fromkeys(TOKEN_RE.findall(str(query).lower())))
+        if not terms: return 0, [], True
+        limit = max(1, min(int(limit), SEARCH_MAX_PAGE_SIZE))
+        with self.lock:
+            lo = self.first + (bisect.bisect_left(self.times, since) if since else 0)
+            hi = self.first + (bisect.bisect_right(self.times, until) if until else len(self.texts))
+            whole = not self.horizon or (since or 0) > self.horizon  # nothing in range was evicted
+            lists = []  # (docs in range, slices, exact-match plist, scored) per term and filter
+            for term in terms:
+                slices, exact, size = [], None, 0
+                for tok in islice(self.vocab.prefixed(term), SEARCH_MAX_EXPANSIONS):
+                    plist = self.postings[tok]
+                    start, end = bisect.bisect_left(plist, lo), bisect.bisect_left(plist, hi)
+                    if start == end: continue
+                    slices.append((plist, start, end)); size += end - start
+                    if tok == term: exact = plist
+                if not slices: return 0, [], whole
+                lists.append((size, slices, exact, True))
+            for name, docs in ((scope, self.scope_docs), (sender, self.sender_docs)):
+                if not name: continue
+                plist = docs.get(self.name_ids.get(name))
+                start, end = (bisect.bisect_left(plist, lo), bisect.bisect_left(plist, hi)) if plist else (0, 0)
+                if start == end: return 0, [], whole
+                lists.append((end - start, [(plist, start, end)], None, False))
+            readable = None if rooms is None else {self.name_ids[room] for room in rooms if room in self.name_ids}
+            lists.sort(key=lambda entry: entry[0])
+            size, driver, driver_exact, driver_scored = lists[0]
+            rest = lists[1:]
+            best = sum(2 if exact is not None else 1 for _, _, exact, scored in lists if scored)
+            hits, top, scanned, last, complete = [], 0, 0, None, True
+            for doc in self._newest_first(driver):
+                scanned += 1
+                if doc == last: continue
+                last = doc
+                scope_id = self.scopes[doc - self.first]
+                name = self.names[scope_id]
+                if name.startswith('@'):
+                    if requester not in name[1:].split('|'): continue
+                elif readable is not None and scope_id not in readable: continue
+                score = 0
+                if driver_scored: score = 2 if driver_exact is not None and self._contains(driver_exact, doc) else 1
+                for _, slices, exact, scored in rest:
+                    if exact is not None and self._contains(exact, doc): score += 2; continue
+                    if not any(self._contains(plist, doc) for plist, _, _ in slices): break
+                    if scored: score += 1
+                else:
+                    hits.append((score, doc))
+                    if score == best:
+                        top += 1
+                        if top >= offset + limit:  # newer best-scoring hits fill the page: nothing left can outrank them
+                            complete = False
+                            break
+            page = heapq.nlargest(offset + limit, hits)[offset:]
+            results = []
+            for score, doc in page:
+                at = doc - self.first
+                result = {'id': doc, 'score': score, 'sender': self.names[self.senders[at]],
+                          'message': self.texts[at], 'time': self.times[at],
+                          'timestamp': datetime.fromtimestamp(self.times[at]).strftime('%Y-%m-%d %H:%M:%S')}
+                name = self.names[self.scopes[at]]
+                if name.startswith('@'):
+                    a, b = name[1:].split('|', 1)
+                    result['peer'] = b if a == requester else a
+                else:
+                    result['room'] = name
+                results.append(result)
+            total = len(hits) if complete else max(len(hits), round(len(hits) * size / scanned))
+            return total, results, complete and whole
+
+class ClientConnection:
+    """
+    A handshaken client socket plus the settings negotiated for it.
+
+    Outbound frames are queued per priority lane and written by one writer thread.
+    Frames larger than CHUNK_SIZE go out as fragments (on 'len' framing), so control,
+    audio and chat can overtake a file that is halfway out. Whatever is queued when the
+    writer wakes (after a short flush window) is written with one vectored sendmsg.
+    """
+    tracer = None  # the Profiler while a --spans profile runs: frames carry their queue time
+    encode = staticmethod(encode_frame)  # every routed frame is encoded through this; timed during --spans
+
+    def __init__(self, sock, addr, username, settings, policy=None, write_stats=None, coalesce=True, flush_window=FLUSH_WINDOW):
+        self.sock = sock
+        self.addr = addr
+        self.username = username
+        self.protocol = settings['protocol']
+        self.framing = settings['framing']
+        self.compression = settings['compression']
+        self.media = settings['media']
+        self.features = set(settings['features'])
+        self.codec = settings['codec']
+        self.wire = (self.framing, self.compression, self.codec)  # frames can be shared between equal wires
+        self.reader = FrameReader(self.framing, self.codec)
+        self.policy = policy or SlowConsumerPolicy()
+
+        # 'plain' media: call_data goes over a second, plaintext connection once it is attached
+        self.media_token = secrets.token_urlsafe(16) if self.media == MEDIA_PLAIN else None
+        self.media_conn = None
+
+        # outbound scheduling
+        self.lanes = [deque() for _ in range(LANE_BULK + 1)]
+        self.cond = threading.Condition()
+        self.queued_bytes = 0
+        self.parked = deque()  # file frames held back while the backlog is over throttle_file_bytes
+        self.parked_bytes = 0
+        self.current = None   # (lane, fragment iterator) of the frame being fragmented
+        self.closed = False
+        self.shed_frames = 0
+        self.coalesce = coalesce
+        self.flush_window = flush_window if coalesce else 0
+        self.vectored = hasattr(sock, 'sendmsg') and not isinstance(sock, ssl.SSLSocket)
+        self.write_stats = write_stats
+        self.frames = self.writes = 0  # frames queued, send calls made
+        self.traced = []               # queue times of the frames in the batch being written (tracer only)
+
+        # liveness (see ChatServer._heartbeat_loop)
+        self.last_recv = time.monotonic()
+        self.ping_id = 0
+        self.ping_sent = None  # monotonic time of the unanswered ping
+
+    def start(self):
+        threading.Thread(target=self._writer_loop, daemon=True).start()
+
+    def send(self, data):
+        self.send_frame(self.encode(data, *self.wire), lane_for(data))
+
+    def send_frame(self, frame, lane=LANE_CONTROL, seq=None):
+        media_conn = self.media_conn
+        if media_conn is not None and lane in (LANE_AUDIO, LANE_VIDEO) and not media_conn.closed:
+            return media_conn.send_frame(frame, lane, seq)
+        policy = self.policy
+        with self.cond:
+            if self.closed: return
+            if lane == LANE_VIDEO and self.queued_bytes > policy.shed_video_bytes:
+                self.shed_frames += 1
+                return
+            if self.queued_bytes + self.parked_bytes + len(frame) > policy.disconnect_bytes:
+                print(f"[SERVER] {self.username} is too slow ({self.queued_bytes + self.parked_bytes} bytes queued), disconnecting")
+                self._close_locked()
+                return
+            item = (frame, seq, time.perf_counter() if self.tracer else 0.0)
+            self.frames += 1
+            if lane == LANE_BULK:
+                # Backpressure without blocking the caller (a routing thread, maybe holding a session
+                # lock): the frame waits here and the writer admits it as the backlog drains.
+                self.parked.append(item)
+                self.parked_bytes += len(frame)
+                self._admit_parked()
+            else:
+                self.lanes[lane].append(item)
+                self.queued_bytes += len(frame)
+            self.cond.notify_all()
+
+    def _admit_parked(self):
+        # Caller holds self.cond. Parked file frames join LANE_BULK, in order, while under the throttle.
+        while self.parked and self.queued_bytes <= self.policy.throttle_file_bytes:
+            item = self.parked.popleft()
+            self.parked_bytes -= len(item[0])
+            self.lanes[LANE_BULK].append(item)
+            self.queued_bytes += len(item[0])
+
+    def _next_chunk(self):
+        # Caller holds self.cond. Returns ([wire buffers], queued bytes they account for) or None.
+        limit = self.current[0] if self.current else len(self.lanes)
+        for lane in range(limit):
+            if self.lanes[lane]:
+                frame, seq, queued = self.lanes[lane].popleft()
+                if queued: self.traced.append(queued)
+                head = [seq_prefix(seq)] if seq is not None else []
+                if self.current is None and self.framing == 'len' and len(frame) > CHUNK_SIZE:
+                    self.current = (lane, fragment_frame(frame))
+                    wire, accounted = next(self.current[1])
+                    return head + [wire], accounted
+                return head + [frame], len(frame)
+        if self.current:
+            chunk = next(self.current[1], None)
+            if chunk is not None: return [chunk[0]], chunk[1]
+            self.current = None
+            return self._next_chunk()
+        return None
+
+    def _next_batch(self):
+        # Caller holds self.cond. Chunks in lane order, up to COALESCE_BYTES / COALESCE_FRAMES.
+        buffers, accounted = [], 0
+        while accounted < COALESCE_BYTES and len(buffers) < COALESCE_FRAMES:
+            chunk = self._next_chunk()
+            if chunk is None: break
+            buffers += chunk[0]
+            accounted += chunk[1]
+            if not self.coalesce: break
+        return buffers, accounted
+
+    def _write(self, buffers):
+        if not self.coalesce:
+            for buf in buffers:
+                self.sock.sendall(buf)
+                self.writes += 1
+        elif not self.vectored:  # TLS (or no sendmsg): one record write
+            self.sock.sendall(b"".join(buffers))
+            self.writes += 1
+        else:
+            while buffers:
+                sent = self.sock.sendmsg(buffers)
+                self.writes += 1
+                while buffers and sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                if sent: buffers[0] = memoryview(buffers[0])[sent:]
+
+    def _writer_loop(self):
+        busy = lambda: self.closed or self.queued_bytes >= COALESCE_BYTES or self.lanes[LANE_AUDIO]
+        try:
+            while True:
+                with self.cond:
+                    idle = not (self.current or any(self.lanes))
+                    self.cond.wait_for(lambda: self.closed or self.current or any(self.lanes))
+                    if idle and self.flush_window and not busy():
+                        self.cond.wait_for(busy, self.flush_window)  # the first frame of a burst: let the rest gather
+                    if self.closed: return
+                    buffers, accounted = self._next_batch()
+                try:
+                    if buffers: self._write(buffers)
+                except Exception as e:
+                    if not self.closed: print("[SERVER] send error for", self.username, e)
+                    self.close()
+                    return
+                if self.traced:
+                    if self.tracer: self.tracer.sent(self.traced)
+                    self.traced = []
+                with self.cond:
+                    self.queued_bytes -= accounted
+                    self._admit_parked()
+                    self.cond.notify_all()
+        finally:
+            if self.write_stats: self.write_stats.add(self.frames, self.writes)
+
+    def _close_locked(self):
+        self.closed = True
+        self.cond.notify_all()
+        try: self.sock.shutdown(socket.SHUT_RDWR)  # wakes the receive thread too
+        except Exception: pass
+        try: self.sock.close()
+        except Exception: pass
+
+    def close(self):
+        with self.cond:
+            self._close_locked()
+        if self.media_conn: self.media_conn.close()
+
+class ChatServer:
+    profile_lock = threading.Lock()  # one profile per process: the ClientConnection hooks it sets are process-wide
+
+    def __init__(self, host='0.0.0.0', port=5555, listen_backlog=LISTEN_BACKLOG,
+                 connect_rate=CONNECT_RATE, connect_burst=CONNECT_BURST,
+                 max_pending_handshakes=MAX_PENDING_HANDSHAKES, handshake_timeout=HANDSHAKE_TIMEOUT,
+                 slow_consumer_policy=None, tls_context=None, plain_media=False, capture=None, handoff=None,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, coalesce=True, flush_window=FLUSH_WINDOW, p2p_files=False,
+                 admin=None):
+        self.host = host
+        self.port = port
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # admission control
+        self.listen_backlog = listen_backlog
+        self.connect_bucket = TokenBucket(connect_rate, connect_burst)
+        self.handshake_slots = threading.BoundedSemaphore(max_pending_handshakes)
+        self.handshake_pool = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS, thread_name_prefix='handshake')
+        self.handshake_timeout = handshake_timeout
+        self.slow_consumer_policy = slow_consumer_policy or SlowConsumerPolicy()
+
+        # output: coalesced writes (see ClientConnection._writer_loop), counted for write_stats()
+        self.write_totals = WriteStats()
+        self.write_options = {'write_stats': self.write_totals, 'coalesce': coalesce, 'flush_window': flush_window}
+
+        # TLS: plaintext media is only worth offering when the main connection is encrypted
+        self.tls_context = tls_context
+        self.media_transports = (MEDIA_PLAIN,) + MEDIA_TRANSPORTS if tls_context and plain_media else MEDIA_TRANSPORTS
+
+        # heartbeats: quiet clients are pinged, silent ones reaped (see _heartbeat_loop)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_interval * HEARTBEAT_MISSES
+        self.heartbeat_stats = HeartbeatStats()
+
+        # direct file transfers: transfer_id -> (sender, recipient, started); see broker_transfer
+        self.transfers = {}
+        self.transfers_lock = threading.Lock()
+        off = {'heartbeat': not heartbeat_interval, 'p2p_files': not p2p_files}
+        self.features = tuple(f for f in SERVER_FEATURES if not off.get(f))
+
+        # traffic capture for Chat_Replay.py (logins, inbound messages, logouts)
+        self.trace = TraceWriter(capture) if capture else None
+
+        # restart handoff: take over from / hand over to another process through this Unix socket
+        self.handoff_path = handoff
+        self.handoff_sock = None
+        self.draining = threading.Event()     # handing over: accept loop parked, drops keep calls
+        self.handed_over = threading.Event()  # the new process has the listening socket
+        self.frozen = False                   # state exported: inbound messages are no longer routed
+        self.deferred = []                    # accepted while handing over; the new process handshakes them
+        self.inherited = False                # listening socket came from a previous process
+
+        # admin commands (profiling) over a Unix socket; self.profiler is set while a profile runs
+        self.admin_path = admin
+        self.admin_sock = None
+        self.profiler = None
+
+        # state
+        self.clients = {}         # username -> ClientConnection
+        self.sessions = {}        # username -> Session (resumable clients, attached or not)
+        self.clients_lock = threading.Lock()
+
+        # Room membership decides who gets a room's chat, files and search results (see room_members / in_room)
+        self.rooms = {'General': []}  # room_name -> list of usernames
+        self.rooms_lock = threading.Lock()
+        self.room_keys = [('general', 'General')]  # sorted (casefolded name, name): the paginated directory
+        self.memberships = {}                       # username -> set of rooms they are in
+
+        # full-text search over room and private messages
+        self.message_index = MessageIndex()
+
+        # file previews: thumbnails/waveforms built off the routing threads
+        self.file_store = FileStore()
+        self.preview_pool = None  # ProcessPoolExecutor, created on first upload
+        self.voice_uploads = {}   # (sender, stream_id) -> VoiceUpload
+        self.voice_lock = threading.Lock()
+
+        # private and group calls, with per-member forwarding lists for call_data
+        self.calls = CallManager()
+
+        # presence: versioned deltas, coalesced per tick (see _presence_loop)
+        self.presence_version = 0
+        self.presence_pending = {}  # username -> True (joined) / False (left) since last tick
+        self.presence_lock = threading.Lock()
+
+    def start(self):
+        if not (self.handoff_path and self.take_over(self.handoff_path)):
+            tune_socket(self.server_sock, 'main')  # inherited by accepted sockets, so the window scale fits
+            self.server_sock.bind((self.host, self.port))
+            self.server_sock.listen(self.listen_backlog)
+        self.server_sock.settimeout(ACCEPT_POLL)
+        print(f"[SERVER] Listening on {self.host}:{self.port}" + (" (TLS)" if self.tls_context else "")
+              + (" (taken over)" if self.inherited else ""))
+        threading.Thread(target=self._presence_loop, daemon=True).start()
+        threading.Thread(target=self._session_loop, daemon=True).start()
+        if self.heartbeat_interval: threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+        if self.handoff_path: self._listen_handoff()
+        if self.admin_path: self._listen_admin()
+        for client_sock in self.deferred:  # handed over unhandshaken by the previous process
+            self.handshake_slots.acquire()
+            self.handshake_pool.submit(self.handshake, client_sock, client_sock.getpeername())
+        self.deferred = []
+        try:
+            while True:
+                if self.draining.is_set():
+                    # Handing over: new connections wait in the (shared) backlog for the new process
+                    if self.handed_over.wait(0.1): break
+                    continue
+                try: client_sock, addr = self.server_sock.accept()
+                except socket.timeout: continue
+                if self.draining.is_set():
+                    if len(self.deferred) < HANDOFF_MAX_SOCKETS: self.deferred.append(client_sock)
+                    else: self.reject(client_sock, 'Server restarting')
+                    continue
+                # Admission control: never block the accept loop on a handshake
+                if not self.connect_bucket.take():
+                    self.reject(client_sock, 'Server busy (connect rate limit)'); continue
+                if not self.handshake_slots.acquire(blocking=False):
+                    self.reject(client_sock, 'Server busy (too many pending handshakes)'); continue
+                self.handshake_pool.submit(self.handshake, client_sock, addr)
+        except KeyboardInterrupt:
+            print("[SERVER] Shutting down")
+        finally:
+            self.server_sock.close()  # only this process's descriptor, after a handoff
+            if self.handoff_sock: self.handoff_sock.close()
+            if self.admin_sock: self.admin_sock.close()
+            frames, writes = self.write_stats()
+            if frames: print(f"[SERVER] Wrote {frames} frames in {writes} send calls ({writes / frames:.3f} per frame)")
+            if self.trace:
+                self.trace.close()
+                print(f"[SERVER] Trace written to {self.trace.path}")
+
+    def write_stats(self):
+        """(frames queued, send calls) over all connections so far."""
+        with self.clients_lock:
+            live = list(self.clients.values())
+        live += [c.media_conn for c in live if c.media_conn]
+        with self.write_totals.lock:
+            frames, writes = self.write_totals.frames, self.write_totals.writes
+        return frames + sum(c.frames for c in live), writes + sum(c.writes for c in live)
+
+    # ---------- restart handoff ----------
+    def _listen_handoff(self):
+        try: os.unlink(self.handoff_path)  # stale, or the previous process's (it no longer needs it)
+        except FileNotFoundError: pass
+        self.handoff_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.handoff_sock.bind(self.handoff_path)
+        os.chmod(self.handoff_path, 0o600)
+        self.handoff_sock.listen(1)
+        threading.Thread(target=self._handoff_loop, daemon=True).start()
+
+    def _handoff_loop(self):
+        while True:
+            try: ctl, _ = self.handoff_sock.accept()
+            except OSError: return
+            try:
+                ctl.settimeout(HANDOFF_ACK_TIMEOUT)
+                if ctl.recv(len(HANDOFF_REQUEST)) != HANDOFF_REQUEST: continue
+                self.hand_over(ctl)
+                return
+            except Exception as e:
+                print("[SERVER] Handoff failed, carrying on:", e)
+                self.frozen = False
+                self.draining.clear()
+                for client_sock in self.deferred:
+                    self.handshake_slots.acquire()
+                    self.handshake_pool.submit(self.handshake, client_sock, client_sock.getpeername())
+                self.deferred = []
+            finally:
+                ctl.close()
+
+    def hand_over(self, ctl):
+        """
+        Old process side. Stops accepting (connections queue in the backlog), tells every
+        client 'server_restart' and waits up to HANDOFF_DRAIN_TIMEOUT for resumable ones to
+        disconnect, so everything they sent has been routed and their sessions are detached.
+        Then sends the listening socket and the exported state, and exits once the new process
+        confirms. Clients without sessions are dropped and log in again; pending file offers and
+        voice uploads don't carry over.
+        """
+        print("[SERVER] Handing over to a new server process")
+        self.draining.set()
+        with self.clients_lock:
+            conns = list(self.clients.values())
+        for conn in conns:
+            conn.send({'type':'server_restart','message':'Server restarting'})
+        deadline = time.monotonic() + HANDOFF_DRAIN_TIMEOUT
+        while time.monotonic() < deadline:
+            with self.clients_lock:
+                if not any(u in self.sessions for u in self.clients): break
+            time.sleep(0.02)
+        self.frozen = True  # from here on the new process owns sessions and sequence numbers
+        state = zlib.compress(CODECS['json'].dumps(self.export_state()), 1)
+        deferred = list(self.deferred)
+        socket.send_fds(ctl, [HANDOFF_HEADER.pack(len(state))], [self.server_sock.fileno()] + [s.fileno() for s in deferred])
+        ctl.sendall(state)
+        if ctl.recv(len(HANDOFF_ACK)) != HANDOFF_ACK:
+            raise ConnectionError("new process did not confirm the handoff")
+        print(f"[SERVER] Handed over {len(self.sessions)} sessions and {len(deferred)} new connections")
+        self.handed_over.set()
+        for client_sock in deferred: client_sock.close()  # the new process has its own descriptors
+
+    def take_over(self, path):
+        """New process side: False if no server is listening on path, else it's handed over."""
+        ctl = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            ctl.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            ctl.close()
+            return False
+        with ctl:
+            ctl.settimeout(HANDOFF_DRAIN_TIMEOUT + HANDOFF_ACK_TIMEOUT)
+            ctl.sendall(HANDOFF_REQUEST)
+            header, fds, _, _ = socket.recv_fds(ctl, HANDOFF_HEADER.size, 1 + HANDOFF_MAX_SOCKETS)
+            if not fds: raise ConnectionError("no listening socket in the handoff")
+            while len(header) < HANDOFF_HEADER.size:
+                chunk = ctl.recv(HANDOFF_HEADER.size - len(header))
+                if not chunk: raise ConnectionError("handoff closed early")
+                header += chunk
+            (length,) = HANDOFF_HEADER.unpack(header)
+            state = bytearray()
+            while len(state) < length:
+                chunk = ctl.recv(min(length - len(state), 1024 * 1024))
+                if not chunk: raise ConnectionError("handoff closed early")
+                state += chunk
+            self.server_sock.close()
+            self.server_sock = socket.socket(fileno=fds[0])
+            self.deferred = [socket.socket(fileno=fd) for fd in fds[1:]]
+            self.import_state(json.loads(zlib.decompress(state)))
+            self.inherited = True
+            ctl.sendall(HANDOFF_ACK)
+        print(f"[SERVER] Took over from the previous process: {len(self.sessions)} sessions, {len(self.rooms)} rooms")
+        return True
+
+    def export_state(self):
+        """Sessions (with replay buffers), rooms, calls, presence version and search index."""
+        with self.clients_lock:
+            sessions = list(self.sessions.values())
+        keep = {s.username for s in sessions}  # clients without a session won't come back as themselves
+        with self.rooms_lock:
+            rooms = {room: [u for u in users if u in keep] for room, users in self.rooms.items()}
+        with self.presence_lock:
+            presence_version = self.presence_version
+        return {'sessions': [s.export() for s in sessions], 'rooms': rooms, 'calls': self.calls.export(keep),
+                'presence_version': presence_version, 'index': self.message_index.export(),
+                'index_horizon': self.message_index.horizon}
+
+    def import_state(self, state):
+        for data in state['sessions']:
+            session = Session.restore(data)
+            self.sessions[session.username] = session
+        self.rooms = state['rooms']
+        self.room_keys = sorted((room.casefold(), room) for room in self.rooms)
+        for room, users in self.rooms.items():
+            for username in users: self.memberships.setdefault(username, set()).add(room)
+        for call in state['calls']:
+            self.calls.restore(call['room'], call['members'])
+        self.presence_version = state['presence_version']
+        for when, scope, sender, text in state['index']:
+            self.message_index.add(scope, sender, text, when)
+        self.message_index.horizon = state['index_horizon']
+
+    # ---------- admin commands (profiling) ----------
+    def _listen_admin(self):
+        try: os.unlink(self.admin_path)
+        except FileNotFoundError: pass
+        self.admin_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.admin_sock.bind(self.admin_path)
+        os.chmod(self.admin_path, 0o600)
+        self.admin_sock.listen(4)
+        threading.Thread(target=self._admin_loop, daemon=True).start()
+
+    def _admin_loop(self):
+        while True:
+            try: ctl, _ = self.admin_sock.accept()
+            except OSError: return
+            threading.Thread(target=self._admin_command, args=(ctl,), daemon=True).start()
+
+    def _admin_command(self, ctl):
+        with ctl:
+            try:
+                ctl.settimeout(HANDSHAKE_TIMEOUT)
+                line = b""
+                while not line.endswith(b"\n") and len(line) < ADMIN_MAX_REQUEST:
+                    data = ctl.recv(ADMIN_MAX_REQUEST)
+                    if not data: break
+                    line += data
+                command = json.loads(line)
+                if command.get('command') != 'profile': raise ValueError(f"unknown command {command.get('command')!r}")
+                folder = command.get('folder') or os.path.join(PROFILE_FOLDER, datetime.now().strftime('%Y%m%d-%H%M%S'))
+                summary = self.profile(float(command.get('seconds', PROFILE_SECONDS)), folder, spans=bool(command.get('spans')),
+                                       allocations=bool(command.get('allocations', True)),
+                                       rate=int(command.get('rate', PROFILE_SAMPLE_RATE)),
+                                       all_threads=bool(command.get('all_threads')))
+                reply = {'ok': True, 'folder': folder, 'summary': summary}
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            try: ctl.sendall(json.dumps(reply).encode() + b"\n")
+            except OSError: pass
+
+    def profile(self, seconds, folder, spans=False, allocations=True, rate=PROFILE_SAMPLE_RATE, all_threads=False):
+        """Profiles the running server for `seconds` (see Chat_Profiler.py); returns the report summary."""
+        if not 0 < seconds <= PROFILE_MAX_SECONDS: raise ValueError(f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]")
+        if rate < 0: raise ValueError("rate must be >= 0")
+        if not self.profile_lock.acquire(blocking=False): raise RuntimeError("a profile is already running")
+        try:
+            print(f"[SERVER] Profiling for {seconds:g} s" + (" with spans" if spans else ""))
+            profiler = Profiler(spans=spans, allocations=allocations, rate=rate, all_threads=all_threads)
+            profiler.start()
+            if spans:
+                ClientConnection.encode = staticmethod(profiler.timed(encode_frame))
+                ClientConnection.tracer = profiler
+            self.profiler = profiler
+            try:
+                time.sleep(seconds)
+            finally:
+                self.profiler = None
+                if spans:
+                    ClientConnection.encode = staticmethod(encode_frame)
+                    ClientConnection.tracer = None
+                profiler.stop()
+            summary = profiler.report(folder)
+            print(f"[SERVER] Profile written to {folder}")
+            return summary
+        finally:
+            self.profile_lock.release()
+
+    # ---------- sending helpers ----------
+    def send_json_to_sock(self, sock, data):
+        # Raw ndjson, only used before/while handshaking
+        try:
+            payload = json.dumps(data) + "\n"
+            sock.sendall(payload.encode('utf-8'))
+        except Exception as e:
+            print("[SERVER] send_json_to_sock error:", e)
+
+    def send_to_client(self, username, data):
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            conn = self.clients.get(username)
+        if session:
+            session.deliver(data)
+        elif conn:
+            conn.send(data)
+
+    def broadcast(self, data, exclude=None, include=None):
+        # include: optional username predicate (e.g. to split recipients by feature)
+        with self.clients_lock:
+            conns = [c for uname, c in self.clients.items()
+                     if uname != exclude and uname not in self.sessions and (include is None or include(uname))]
+            sessions = [s for uname, s in self.sessions.items() if uname != exclude and (include is None or include(uname))]
+        lane = lane_for(data)
+        frames = {}  # encode once per wire format, not once per client
+        def frame_for(wire):
+            frame = frames.get(wire)
+            if frame is None:
+                frame = frames[wire] = ClientConnection.encode(data, *wire)
+            return frame
+        for conn in conns:
+            conn.send_frame(frame_for(conn.wire), lane)
+        for session in sessions:
+            wire = session.wire
+            session.deliver(data, (frame_for(wire), wire), lane)
+
+    def broadcast_to_room(self, room, data, exclude=None):
+        # NOTE: This method is now only used for Group Call Signaling and End Call notifications,
+        # where explicit room membership (self.rooms[room]) is needed.
+        with self.rooms_lock:
+            users = list(self.rooms.get(room, []))
+        for uname in users:
+            if uname == exclude:
+                continue
+            self.send_to_client(uname, data)
+
+    def has_feature(self, username, feature):
+        # Caller may hold clients_lock (broadcast predicates run under it)
+        session = self.sessions.get(username)
+        if session: return feature in session.features
+        conn = self.clients.get(username)
+        return bool(conn) and feature in conn.features
+
+    # ---------- rooms ----------
+    def _add_room_locked(self, room):
+        if room not in self.rooms:
+            self.rooms[room] = []
+            bisect.insort(self.room_keys, (room.casefold(), room))
+
+    def _join_room_locked(self, room, username):
+        joined = self.memberships.setdefault(username, set())
+        if room not in joined:
+            joined.add(room)
+            self.rooms[room].append(username)
+
+    def _leave_room_locked(self, room, username):
+        joined = self.memberships.get(username)
+        if joined and room in joined:
+            joined.discard(room)
+            self.rooms[room].remove(username)
+
+    def room_members(self, sender, room):
+        """Members of room if sender may post to it (see readable_rooms), else None."""
+        readable = self.readable_rooms(sender)
+        with self.rooms_lock:
+            if room not in self.rooms or (readable is not None and room not in readable): return None
+            return set(self.rooms[room])
+
+    def in_room(self, members):
+        """broadcast() predicate for a room: its members, and clients without the directory (they filter themselves)."""
+        return lambda u: u in members or not self.has_feature(u, 'room_directory')
+
+    def readable_rooms(self, username):
+        """Rooms whose chat username gets: its own, or None (every room) for clients without the directory."""
+        if not self.has_feature(username, 'room_directory'): return None
+        with self.rooms_lock:
+            return set(self.memberships.get(username, ()))
+
+    def joined_rooms(self, username):
+        with self.rooms_lock:
+            return ['General'] + sorted(r for r in self.memberships.get(username, ()) if r != 'General')
+
+    def list_rooms(self, username, prefix='', after=None, limit=ROOM_PAGE_SIZE):
+        """
+        One page of the room directory: rooms whose name starts with prefix (ignoring case), in
+        name order, after the cursor `after` (the last name of the previous page). Returns
+        ([{'name', 'members', 'joined'}], cursor of the next page or None).
+        """
+        limit = max(1, min(int(limit), ROOM_MAX_PAGE_SIZE))
+        folded = prefix.casefold()
+        page = []
+        with self.rooms_lock:
+            keys = self.room_keys
+            i = bisect.bisect_left(keys, (folded,))
+            if after is not None: i = max(i, bisect.bisect_right(keys, (after.casefold(), after)))
+            joined = self.memberships.get(username, ())
+            while i < len(keys) and keys[i][0].startswith(folded):
+                if len(page) == limit: return page, page[-1]['name']
+                name = keys[i][1]
+                page.append({'name': name, 'members': len(self.rooms[name]), 'joined': name in joined})
+                i += 1
+        return page, None
+
+    # ---------- files / previews ----------
+    def route_file(self, sender, recipient, payload, room=None):
+        """A 'file' for recipient, or else for room (default General): its readers only, like room chat."""
+        if not recipient:
+            room = room or 'General'
+            members = self.room_members(sender, room)
+            if members is None:
+                self.send_to_client(sender, {'type':'error','message':f"You are not in room {room!r}"})
+                return
+            payload['room'] = room
+            in_room = self.in_room(members)
+        job = preview_job(payload.get('filetype'))
+        if job is None:
+            if recipient: self.send_to_client(recipient, payload)
+            else: self.broadcast(payload, exclude=sender, include=in_room)
+            return
+        # Legacy clients still get the full file right away
+        wants = lambda u: self.has_feature(u, 'previews')
+        if recipient:
+            if not wants(recipient):
+                self.send_to_client(recipient, payload)
+                return
+            audience = {sender, recipient}
+        else:
+            self.broadcast(payload, exclude=sender, include=lambda u: in_room(u) and not wants(u))
+            with self.clients_lock:
+                audience = {u for u in self.clients.keys() | self.sessions.keys() if in_room(u)} | {sender}
+        file_id = self.file_store.put(payload, audience=audience)
+        offer = {'type':'file_offer','file_id':file_id,'sender':sender,'filename':payload.get('filename'),
+                 'filetype':payload.get('filetype'),'size':len(payload.get('filedata') or '') * 3 // 4,
+                 'timestamp':payload.get('timestamp')}
+        if not recipient: offer['room'] = room
+        def send_offer(future):
+            try: offer['preview'] = future.result()
+            except Exception as e: print("[SERVER] preview failed for", payload.get('filename'), e)
+            if recipient: self.send_to_client(recipient, offer)
+            else: self.broadcast(offer, exclude=sender, include=lambda u: in_room(u) and wants(u))
+        if self.preview_pool is None:
+            self.preview_pool = ProcessPoolExecutor(max_workers=PREVIEW_WORKERS)
+        self.preview_pool.submit(job, payload.get('filedata') or '').add_done_callback(send_offer)
+
+    def broker_transfer(self, sender, message):
+        """
+        'p2p_offer': a direct transfer of a private file. The sender gets a one-time token
+        ('p2p_ready'); the recipient gets the offer, the sender's endpoint and the same token.
+        The endpoint is the address this connection comes from: a sender can't point the
+        recipient at another host. A refusal is a 'p2p_result' so the sender relays.
+        """
+        transfer_id = str(message.get('transfer_id') or '')[:64]
+        recipient = message.get('recipient')
+        with self.clients_lock:
+            conn = self.clients.get(sender)
+            online = recipient in self.clients  # offers aren't replayed to a detached session
+        def refuse(reason):
+            self.send_to_client(sender, {'type':'p2p_result','transfer_id':transfer_id,'ok':False,'reason':reason})
+        if not conn or not transfer_id or not online or not self.has_feature(recipient, 'p2p_files'):
+            return refuse(f"{recipient} can't receive files directly")
+        try:
+            port, size = int(message.get('port')), int(message.get('size'))
+        except (TypeError, ValueError):
+            return refuse("bad port or size")
+        if not 0 < port < 65536: return refuse("bad port")
+        if not 0 <= size <= P2P_MAX_BYTES: return refuse("file too large to send directly")
+        token = secrets.token_urlsafe(16)
+        with self.transfers_lock:
+            if transfer_id in self.transfers or sum(1 for s, _, _ in self.transfers.values() if s == sender) >= P2P_MAX_PENDING:
+                return refuse("too many direct transfers in progress")
+            self.transfers[transfer_id] = (sender, recipient, time.monotonic())
+        self.send_to_client(sender, {'type':'p2p_ready','transfer_id':transfer_id,'token':token})
+        self.send_to_client(recipient, {'type':'p2p_offer','transfer_id':transfer_id,'sender':sender,
+                                        'filename':message.get('filename'),'filetype':message.get('filetype'),
+                                        'size':size,'endpoints':[[conn.addr[0], port]],
+                                        'token':token,'timestamp':datetime.now().strftime('%H:%M:%S')})
+
+    def finish_transfer(self, reporter, message):
+        """'p2p_result' from the recipient: forgotten here, forwarded to the sender."""
+        transfer_id = message.get('transfer_id')
+        with self.transfers_lock:
+            transfer = self.transfers.get(transfer_id)
+            if not transfer or transfer[1] != reporter: return
+            del self.transfers[transfer_id]
+        self.send_to_client(transfer[0], {'type':'p2p_result','transfer_id':transfer_id,'ok':bool(message.get('ok')),
+                                          'reason':str(message.get('reason') or '')[:200]})
+
+    def handle_voice_stream(self, sender, mtype, message):
+        key = (sender, message.get('stream_id'))
+        try:
+            if mtype == 'voice_start':
+                if not message.get('recipient') and self.room_members(sender, message.get('room') or 'General') is None:
+                    raise ValueError(f"you are not in room {message.get('room')!r}")
+                upload = VoiceUpload(sender, message)
+                with self.voice_lock:
+                    if sum(1 for s, _ in self.voice_uploads if s == sender) >= VOICE_MAX_STREAMS:
+                        raise ValueError("too many voice uploads in progress")
+                    self.voice_uploads[key] = upload
+                return
+            with self.voice_lock:
+                upload = self.voice_uploads.get(key) if mtype == 'voice_chunk' else self.voice_uploads.pop(key, None)
+            if upload is None: return
+            if mtype == 'voice_chunk':
+                upload.add(message.get('seq'), message.get('data'))
+            elif mtype == 'voice_cancel':
+                upload.close()
+            else:
+                payload = {'type':'file','sender':sender,'filename':upload.filename,'filedata':upload.finish(),
+                           'filetype':'.wav','timestamp':datetime.now().strftime('%H:%M:%S')}
+                self.route_file(sender, upload.recipient, payload, upload.room)
+        except Exception as e:
+            with self.voice_lock:
+                upload = self.voice_uploads.pop(key, None)
+            if upload: upload.close()
+            self.send_to_client(sender, {'type':'error','message':f'Voice message failed: {e}'})
+
+    def drop_voice_uploads(self, username):
+        with self.voice_lock:
+            keys = [k for k in self.voice_uploads if k[0] == username]
+            uploads = [self.voice_uploads.pop(k) for k in keys]
+        for upload in uploads: upload.close()
+
+    # ---------- presence ----------
+    def send_presence_snapshot(self, username):
+        # Full list, only sent on connect or when a client reports a version gap.
+        with self.presence_lock:
+            with self.clients_lock:
+                clients = list(self.clients.keys() | self.sessions.keys())  # held sessions count as online
+            version = self.presence_version
+        self.send_to_client(username, {'type':'client_list','clients':clients,'version':version})
+
+    def queue_presence(self, username, online):
+        with self.presence_lock:
+            # join+leave (or leave+join) within one tick cancel out
+            if self.presence_pending.get(username) is (not online):
+                del self.presence_pending[username]
+            else:
+                self.presence_pending[username] = online
+
+    def _presence_loop(self):
+        while True:
+            time.sleep(PRESENCE_TICK)
+            with self.presence_lock:
+                if not self.presence_pending: continue
+                pending, self.presence_pending = self.presence_pending, {}
+                self.presence_version += 1
+                version = self.presence_version
+            has_presence = lambda u: self.has_feature(u, 'presence')
+            self.broadcast({'type':'presence','version':version,
+                            'joined':[u for u, on in pending.items() if on],
+                            'left':[u for u, on in pending.items() if not on]}, include=has_presence)
+            # Clients without deltas (protocol 0, or just not 'presence') get the whole list, as before
+            with self.clients_lock:
+                if all(map(has_presence, self.clients)): continue
+                clients = list(self.clients.keys() | self.sessions.keys())
+            self.broadcast({'type':'client_list','clients':clients,'version':version}, include=lambda u: not has_presence(u))
+
+    # ---------- admission / handshake ----------
+    def reject(self, client_sock, reason):
+        try:
+            client_sock.setblocking(False)
+            client_sock.send((json.dumps({'type':'error','message':reason,'retry_after':RETRY_AFTER}) + "\n").encode('utf-8'))
+        except Exception: pass
+        try: client_sock.close()
+        except Exception: pass
+
+    def read_hello(self, client_sock):
+        """Returns (hello dict, leftover bytes). Legacy clients send a bare username."""
+        deadline = time.monotonic() + self.handshake_timeout
+        data = b""
+        while True:
+            chunk = client_sock.recv(4096)
+            if not chunk: raise ProtocolError("closed during handshake")
+            data += chunk
+            if not data.lstrip().startswith(b'{'):
+                return {'type':'hello','username':data.decode('utf-8', errors='ignore').strip(),'protocol':0}, b""
+            if b"\n" in data:
+                line, rest = data.split(b"\n", 1)
+                return json.loads(line), rest
+            if len(data) > MAX_HELLO_SIZE or time.monotonic() > deadline:
+                raise ProtocolError("incomplete hello")
+
+    def handshake(self, client_sock, addr):
+        conn, handler = None, self.handle_client
+        try:
+            client_sock.settimeout(self.handshake_timeout)
+            set_keepalive(client_sock)
+            if self.tls_context and client_sock.recv(1, socket.MSG_PEEK) == TLS_RECORD_BYTE:
+                # The TLS handshake runs here, on a pool thread, never on the accept loop
+                client_sock = self.tls_context.wrap_socket(client_sock, server_side=True)
+            hello, leftover = self.read_hello(client_sock)
+            if hello.get('type') == 'media_hello':
+                tune_socket(client_sock, 'media')
+                conn, handler = self.attach_media(client_sock, addr, hello), self.handle_media
+            else:
+                tune_socket(client_sock, 'main')
+                conn = self.login(client_sock, addr, hello)
+        except Exception as e:
+            print("[SERVER] handshake failed for", addr, e)
+            conn = None
+        finally:
+            self.handshake_slots.release()
+        if not conn:
+            try: client_sock.close()
+            except Exception: pass
+            return
+        client_sock.settimeout(None)
+        threading.Thread(target=handler, args=(conn, leftover), daemon=True).start()
+        if self.draining.is_set() and handler == self.handle_client:
+            conn.send({'type':'server_restart','message':'Server restarting'})  # logged in mid-handoff
+
+    def login(self, client_sock, addr, hello):
+        tls = isinstance(client_sock, ssl.SSLSocket)
+        if self.tls_context and not tls:
+            self.send_json_to_sock(client_sock, {'type':'error','message':'This server requires TLS'})
+            raise ProtocolError("plaintext login on a TLS server")
+        username = str(hello.get('username') or '').strip()
+        if hello.get('type') != 'hello' or not username:
+            raise ProtocolError("bad hello")
+        try:
+            settings = negotiate(hello, features=self.features, media=self.media_transports)
+        except ProtocolError as e:
+            self.send_json_to_sock(client_sock, {'type':'error','message':f'Handshake failed: {e}'})
+            raise
+        if settings['framing'] != 'len' and 'resume' in settings['features']:
+            settings['features'].remove('resume')  # sequence numbers need 'len' framing
+        resume = hello.get('resume')
+        if resume and 'resume' in settings['features']:
+            conn = self.resume(client_sock, addr, username, settings, resume)
+        else:
+            conn = self.register(client_sock, addr, username, settings)
+        if conn and self.trace:
+            self.trace.record(TRACE_LOGIN, username, {'features': sorted(conn.features)})
+        if conn:
+            detail = f", {client_sock.version()}{' resumed' if client_sock.session_reused else ''}" if tls else ""
+            print(f"[SERVER] {username} connected from {addr} (protocol {conn.protocol}, {conn.framing}/{conn.compression}/{conn.codec}{detail})")
+        return conn
+
+    def register(self, client_sock, addr, username, settings):
+        conn = ClientConnection(client_sock, addr, username, settings, self.slow_consumer_policy, **self.write_options)
+        session = Session(username, conn.wire, conn.features) if 'resume' in conn.features else None
+        with self.clients_lock:
+            stale = self.sessions.get(username)
+            if username in self.clients or (stale and stale.detached_at is None):
+                self.send_json_to_sock(client_sock, {'type':'error','message':'Username taken'})
+                return None
+            if stale:
+                # Same name logging in fresh while its old session waits to resume: drop the old one
+                self.sessions.pop(username)
+            self.clients[username] = conn
+            if session:
+                self.sessions[username] = session
+                session.conn = conn
+        directory = 'room_directory' in conn.features  # gets the rooms it is in, browses the rest (list_rooms)
+        with self.rooms_lock:
+            self._add_room_locked('General')
+            self._join_room_locked('General', username)
+            rooms = None if directory else list(self.rooms.keys())
+        welcome = {'type':'welcome','message':f'Welcome {username}','rooms': self.joined_rooms(username) if directory else rooms}
+        if conn.protocol >= 1:
+            welcome.update(settings)
+        if session:
+            welcome['session'] = session.token
+        if 'heartbeat' in conn.features:
+            welcome['heartbeat'] = self.heartbeat_interval
+        if conn.media_token:
+            welcome['media_token'] = conn.media_token
+        # The (ndjson) welcome goes out before the writer starts, so no frame queued
+        # for this connection in the meantime can overtake it.
+        self.send_json_to_sock(client_sock, welcome)
+        conn.start()
+        self.send_presence_snapshot(username)
+        self.queue_presence(username, True)
+        return conn
+
+    def resume(self, client_sock, addr, username, settings, resume):
+        """Re-attaches a dropped session: replays missed messages, no presence churn."""
+        with self.clients_lock:
+            session = self.sessions.get(username)
+            if not session or not secrets.compare_digest(str(resume.get('token', '')), session.token):
+                session = None
+            else:
+                old = self.clients.get(username)
+                conn = ClientConnection(client_sock, addr, username, settings, self.slow_consumer_policy, **self.write_options)
+                self.clients[username] = conn
+        if not session:
+            # Unknown or expired: carry on as a fresh login
+            return self.register(client_sock, addr, username, settings)
+        if old:
+            session.detach(old)  # half-open predecessor; its handler will find nothing to clean up
+            old.close()
+            self.end_calls(username)  # calls can't survive the old connection
+        welcome = {'type':'welcome','message':f'Welcome back {username}','rooms': self.joined_rooms(username),
+                   'session': session.token, 'resumed': True}
+        welcome.update(settings)
+        if 'heartbeat' in conn.features:
+            welcome['heartbeat'] = self.heartbeat_interval
+        if conn.media_token:
+            welcome['media_token'] = conn.media_token
+        # Welcome first, then the replay is queued before any live traffic (attach holds the session lock)
+        self.send_json_to_sock(client_sock, welcome)
+        complete = session.attach(conn, int(resume.get('last_seq', 0)))
+        self.calls.rebind(username, conn)  # calls handed over by a previous process continue
+        if not complete:
+            conn.send({'type':'replay_gap','message':'Some messages sent while you were away were dropped'})
+        conn.start()
+        self.send_presence_snapshot(username)
+        return conn
+
+    def attach_media(self, client_sock, addr, hello):
+        """Binds a plaintext media connection to its user's (TLS) main connection; one-time token."""
+        username = str(hello.get('username') or '')
+        with self.clients_lock:
+            main = self.clients.get(username)
+            token = main.media_token if main else None
+            if not token or not secrets.compare_digest(str(hello.get('token', '')), token):
+                raise ProtocolError("bad media token")
+            main.media_token = None
+        settings = {'protocol': main.protocol, 'framing': main.framing, 'compression': main.compression,
+                    'codec': main.codec, 'media': 'inband', 'features': []}
+        conn = ClientConnection(client_sock, addr, username, settings, self.slow_consumer_policy, **self.write_options)
+        self.send_json_to_sock(client_sock, {'type':'media_ready'})
+        conn.start()
+        main.media_conn = conn
+        if main.closed: conn.close()  # main went away while we were attaching
+        print(f"[SERVER] {username} attached a plaintext media connection from {addr}")
+        return conn
+
+    def _session_loop(self):
+        while True:
+            time.sleep(1.0)
+            now = time.monotonic()
+            with self.clients_lock:
+                expired = [u for u, s in self.sessions.items()
+                           if s.detached_at is not None and now - s.detached_at > SESSION_GRACE]
+                for username in expired:
+                    self.sessions.pop(username)
+            for username in expired:
+                print(f"[SERVER] session for {username} expired")
+                self.cleanup_user(username)
+            with self.transfers_lock:
+                for transfer_id in [t for t, (_, _, started) in self.transfers.items() if now - started > P2P_TRANSFER_TIMEOUT]:
+                    del self.transfers[transfer_id]
+
+    def _heartbeat_loop(self):
+        """
+        Pings 'heartbeat' clients that have been quiet for an interval and closes the ones
+        silent for heartbeat_timeout (their handler then frees the connection, session and
+        call state as for any drop). Anything received counts as a sign of life.
+        """
+        stats = self.heartbeat_stats
+        tick = min(HEARTBEAT_TICK, self.heartbeat_interval / 4)
+        last_report, reported = time.monotonic(), None
+        while True:
+            time.sleep(tick)
+            now = time.monotonic()
+            if not self.draining.is_set():
+                with self.clients_lock:
+                    conns = [c for c in self.clients.values() if 'heartbeat' in c.features]
+                for conn in conns:
+                    silent = now - conn.last_recv
+                    if silent > self.heartbeat_timeout:
+                        print(f"[SERVER] {conn.username} silent for {silent:.0f}s, reaping the connection")
+                        stats.count('reaped')
+                        conn.close()  # wakes its handle_client, which disconnects it
+                    elif silent >= self.heartbeat_interval and (conn.ping_sent is None or now - conn.ping_sent >= self.heartbeat_interval):
+                        conn.ping_id += 1
+                        conn.ping_sent = now
+                        conn.send({'type':'ping','id':conn.ping_id})
+                        stats.count('pings')
+            if now - last_report >= HEARTBEAT_REPORT:
+                last_report, snapshot = now, stats.snapshot()
+                if snapshot != reported:
+                    reported = snapshot
+                    print("[SERVER] heartbeat:", ", ".join(f"{k} {v:.1f}" if isinstance(v, float) else f"{k} {v}"
+                                                           for k, v in snapshot.items()))
+
+    # ---------- main connection handler ----------
+    def handle_client(self, conn, leftover=b""):
+        username = conn.username
+        trace = self.trace
+        recv_size = SOCKET_CLASSES['main']['recv']
+        try:
+            data = leftover
+            while True:
+                profiler = self.profiler
+                if profiler: received = time.perf_counter()
+                messages = conn.reader.feed(data)
+                if profiler and messages: decode = (time.perf_counter() - received) / len(messages)
+                for obj in messages:
+                    if trace: trace.record(TRACE_MESSAGE, username, obj)
+                    if profiler: profiler.route(self.process_message, username, obj, received, decode)
+                    else: self.process_message(username, obj)
+                data = conn.sock.recv(recv_size)
+                if not data: break
+                conn.last_recv = time.monotonic()
+        except Exception as e:
+            if isinstance(e, TimeoutError): self.heartbeat_stats.count('reaped_keepalive')  # no socket timeout is set: keepalive gave up
+            if not conn.closed: print("[SERVER] handle_client error for", username, e)
+        finally:
+            if trace: trace.record(TRACE_LOGOUT, username)
+            self.disconnect(username, conn)
+
+    def handle_media(self, conn, leftover=b""):
+        """Reader for a plaintext media connection: only call_data is accepted on it."""
+        try:
+            data = leftover
+            while True:
+                for obj in conn.reader.feed(data):
+                    if obj.get('type') == 'call_data':
+                        if self.trace: self.trace.record(TRACE_MESSAGE, conn.username, obj)
+                        self.process_message(conn.username, obj)
+                data = conn.sock.recv(SOCKET_CLASSES['media']['recv'])
+                if not data: break
+        except Exception as e:
+            if not conn.closed: print("[SERVER] media connection error for", conn.username, e)
+        finally:
+            conn.close()
+
+    # ---------- message routing (FIXED for Chat/File Reliability) ----------
+    def process_message(self, sender, message):
+        if self.frozen: return
+        mtype = message.get('type')
+        if mtype == 'chat':
+            room = message.get('room','General')
+            members = self.room_members(sender, room)
+            if members is None:
+                self.send_to_client(sender, {'type':'error','message':f"You are not in room {room!r}"})
+                return
+            payload = {'type':'chat','sender': sender,'message': message.get('message'),'room': room,'timestamp': datetime.now().strftime('%H:%M:%S')}
+            self.broadcast(payload, exclude=sender, include=self.in_room(members))
+            self.message_index.add(room, sender, payload['message'] or '')
+            
+        elif mtype == 'private':
+            recipient = message.get('recipient')
+            payload = {'type':'private','sender': sender,'message': message.get('message'),'timestamp': datetime.now().strftime('%H:%M:%S')}
+            self.send_to_client(recipient, payload)
+            if recipient:
+                self.message_index.add(MessageIndex.private_scope(sender, recipient), sender, payload['message'] or '')
+
+        elif mtype == 'search_request':
+            peer = message.get('peer')
+            scope = MessageIndex.private_scope(sender, peer) if peer else message.get('room')
+            readable = self.readable_rooms(sender)
+            if not peer and scope and readable is not None and scope not in readable:
+                self.send_to_client(sender, {'type':'error','message':f"You are not in room {scope!r}"})
+                return
+            started = time.perf_counter()
+            try:
+                total, results, exact = self.message_index.search(
+                    message.get('query', ''), sender, rooms=readable, scope=scope, sender=message.get('sender'),
+                    since=message.get('since'), until=message.get('until'),
+                    offset=max(0, int(message.get('offset', 0))), limit=message.get('limit', SEARCH_PAGE_SIZE))
+            except (TypeError, ValueError) as e:
+                self.send_to_client(sender, {'type':'error','message':f'Bad search request: {e}'})
+                return
+            self.send_to_client(sender, {'type':'search_results','request_id': message.get('request_id'),
+                                         'query': message.get('query', ''), 'offset': int(message.get('offset', 0)),
+                                         'total': total, 'total_exact': exact, 'results': results,
+                                         'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)})
+            
+        elif mtype == 'file':
+            recipient = message.get('recipient')
+            payload = {'type':'file','sender': sender,'filename': message.get('filename'),'filedata': message.get('filedata'),'filetype': message.get('filetype'),'timestamp': datetime.now().strftime('%H:%M:%S')}
+            self.route_file(sender, recipient, payload, message.get('room'))
+
+        elif mtype == 'p2p_offer':
+            self.broker_transfer(sender, message)
+
+        elif mtype == 'p2p_result':
+            self.finish_transfer(sender, message)
+
+        elif mtype in ('voice_start', 'voice_chunk', 'voice_end', 'voice_cancel'):
+            self.handle_voice_stream(sender, mtype, message)
+
+        elif mtype == 'file_fetch':
+            payload = self.file_store.get(message.get('file_id'), sender)
+            if payload:
+                self.send_to_client(sender, dict(payload, file_id=message.get('file_id')))
+            else:
+                self.send_to_client(sender, {'type':'error','message':'File is no longer available'})
+
+        elif mtype == 'ping':
+            self.send_to_client(sender, {'type':'pong','id':message.get('id')})
+
+        elif mtype == 'pong':
+            with self.clients_lock:
+                conn = self.clients.get(sender)
+            if conn and conn.ping_sent is not None and message.get('id') == conn.ping_id:
+                self.heartbeat_stats.pong(time.monotonic() - conn.ping_sent)
+                conn.ping_sent = None
+
+        elif mtype == 'presence_sync':
+            self.send_presence_snapshot(sender)
+
+        elif mtype == 'logout':
+            # Explicit quit: don't hold the session for a resume that won't come
+            with self.clients_lock:
+                self.sessions.pop(sender, None)
+                conn = self.clients.get(sender)
+            if conn: conn.close()
+                
+        elif mtype == 'create_room':
+            room_name = message.get('room_name')
+            if not isinstance(room_name, str) or not room_name.strip() or len(room_name) > ROOM_NAME_MAX or room_name.startswith('@'):
+                self.send_to_client(sender, {'type':'error','message':f"Room names are 1-{ROOM_NAME_MAX} characters, not starting with '@'"})
+                return
+            # Clients without the directory are told about every room (and put in it for group calls, as
+            # they always were); directory clients only hear about the rooms they create or join.
+            with self.clients_lock:
+                legacy = [u for u in self.clients if not self.has_feature(u, 'room_directory')]
+            with self.rooms_lock:
+                if room_name not in self.rooms:
+                    self._add_room_locked(room_name)
+                    for username in legacy: self._join_room_locked(room_name, username)
+                self._join_room_locked(room_name, sender)
+            announce = set(legacy) | {sender}
+            self.broadcast({'type':'room_created','room_name':room_name,'creator':sender}, include=announce.__contains__)
+
+        elif mtype == 'room_list_request':
+            try:
+                rooms, cursor = self.list_rooms(sender, str(message.get('prefix') or ''), message.get('after'),
+                                                message.get('limit', ROOM_PAGE_SIZE))
+            except (TypeError, ValueError, AttributeError) as e:
+                self.send_to_client(sender, {'type':'error','message':f'Bad room list request: {e}'})
+                return
+            self.send_to_client(sender, {'type':'room_list','request_id': message.get('request_id'),
+                                         'prefix': message.get('prefix') or '', 'after': message.get('after'),
+                                         'rooms': rooms, 'next': cursor})
+
+        elif mtype in ('join_room', 'leave_room'):
+            room = message.get('room')
+            with self.rooms_lock:
+                if not isinstance(room, str) or room not in self.rooms or (mtype == 'leave_room' and room == 'General'): room = None
+                elif mtype == 'join_room': self._join_room_locked(room, sender)
+                else: self._leave_room_locked(room, sender)
+                members = len(self.rooms[room]) if room else 0
+            if room is None:
+                self.send_to_client(sender, {'type':'error','message':f"Can't {mtype.replace('_', ' ')} {message.get('room')!r}"})
+                return
+            self.send_to_client(sender, {'type':'room_joined' if mtype == 'join_room' else 'room_left',
+                                         'room': room, 'members': members})
+        
+        # --- PRIVATE CALL SIGNALING ---
+        elif mtype == 'call_request':
+            recipient = message.get('recipient')
+            self.send_to_client(recipient, {'type':'call_request','caller':sender,'call_type':message.get('call_type'),'timestamp': datetime.now().strftime('%H:%M:%S')})
+        elif mtype == 'call_response':
+            caller = message.get('caller')
+            accepted = message.get('accepted')
+            call_type = message.get('call_type','both')
+            if accepted:
+                with self.clients_lock:
+                    callee_conn, caller_conn = self.clients.get(sender), self.clients.get(caller)
+                if callee_conn and caller_conn:
+                    self.end_calls(sender); self.end_calls(caller)
+                    self.calls.start_private(sender, callee_conn, caller, caller_conn)
+            self.send_to_client(caller, {'type':'call_response','responder':sender,'accepted':accepted,'call_type':call_type})
+
+        # --- GROUP CALL SIGNALING ---
+        elif mtype == 'group_call_request':
+            room = message.get('room')
+            call_type = message.get('call_type','video')
+            with self.rooms_lock:
+                if room not in self.rooms: return
+            self.join_group_call(room, sender)
+            
+            # Broadcast request to all room members (excluding the caller)
+            self.broadcast_to_room(room, {
+                'type':'group_call_request',
+                'room':room,
+                'caller':sender,
+                'call_type':call_type,
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            }, exclude=sender)
+
+        elif mtype == 'group_call_join':
+            if not self.join_group_call(message.get('room'), sender, create=False):
+                self.send_to_client(sender, {'type':'call_ended','peer':message.get('room')})
+
+        # --- MEDIA DATA FORWARDING ---
+        elif mtype == 'call_data':
+            # Hot path: one lookup for the sender's precomputed recipients, one encode per wire
+            targets = self.calls.routes_for(sender)
+            if not targets:
+                msg_room = message.get('room')
+                if not msg_room or self.calls.call_of(sender) or not self.join_group_call(msg_room, sender, create=False):
+                    return
+                targets = self.calls.routes_for(sender)  # older clients join a group call by sending to it
+            vad = message.get('vad')  # a dict, or a CallData from binary codecs: both answer get()
+            if vad: self.note_voice(sender)
+            self.forward(CallData(sender=sender, data=message.get('data'), data_type=message.get('data_type'), vad=vad), targets)
+
+
+        # --- END CALL ---
+        elif mtype == 'end_call':
+            self.end_calls(sender)
+            peer = message.get('room') if message.get('is_group', False) else sender
+            self.send_to_client(sender, {'type':'call_ended','peer':peer}) # Self-confirmation
+
+        else:
+            print("[SERVER] Unknown message type from", sender, mtype)
+
+    def disconnect(self, username, conn=None):
+        if not username: return
+        with self.clients_lock:
+            if conn is not None and self.clients.get(username) is not conn: return
+            conn = self.clients.pop(username, None)
+            session = self.sessions.get(username)
+        if conn:
+            conn.close()
+        if session and conn and session.detach(conn):
+            # Keep rooms/presence for SESSION_GRACE so the client can resume; calls can't survive
+            print(f"[SERVER] {username} dropped, holding session for {SESSION_GRACE:.0f}s")
+            if self.draining.is_set(): return  # restarting: calls go to the new process
+            self.end_calls(username)
+            self.drop_voice_uploads(username)
+            return
+        if session:
+            with self.clients_lock:
+                if self.sessions.get(username) is session: self.sessions.pop(username)
+        self.cleanup_user(username)
+
+    def cleanup_user(self, username):
+        with self.rooms_lock:
+            for room in self.memberships.pop(username, ()):
+                self.rooms[room].remove(username)
+        self.end_calls(username)
+        self.drop_voice_uploads(username)
+        print(f"[SERVER] {username} disconnected")
+        self.queue_presence(username, False)
+
+    def end_calls(self, username):
+        """Takes username out of its call (if any) and tells whoever is affected."""
+        left = self.calls.leave(username)
+        if not left: return
+        call, remaining, ended = left
+        if call.room is None:
+            for peer in remaining:
+                self.send_to_client(peer, {'type':'call_ended','peer':username})
+        elif ended:
+            self.broadcast_to_room(call.room, {'type':'call_ended','peer':call.room}) # Notify room call is over
+
+    def join_group_call(self, room, username, create=True):
+        with self.clients_lock:
+            conn = self.clients.get(username)
+        if not conn or not room: return None
+        current = self.calls.call_of(username)
+        if current and current.room != room:
+            self.end_calls(username)
+        return self.calls.join_group(room, username, conn, create)
+
+    def note_voice(self, username):
+        """
+        A voiced audio packet (client VAD) from username. In a group call the floor passes
+        to them once the current speaker has been quiet for ACTIVE_SPEAKER_HOLD; members are
+        told with an 'active_speaker' message, so this costs one dict store per packet.
+        """
+        call = self.calls.call_of(username)
+        if call is None or call.room is None: return
+        now = time.monotonic()
+        call.voiced[username] = now
+        current = call.speaker
+        if current == username or (current is not None and now - call.voiced.get(current, 0.0) < ACTIVE_SPEAKER_HOLD):
+            return
+        call.speaker = username
+        self.forward({'type':'active_speaker','room':call.room,'speaker':username}, [c for c in call.members.values() if c])
+
+    def forward(self, payload, conns):
+        lane = lane_for(payload)
+        frames = {}  # encode once per wire format
+        for conn in conns:
+            frame = frames.get(conn.wire)
+            if frame is None:
+                frame = frames[conn.wire] = ClientConnection.encode(payload, *conn.wire)
+            conn.send_frame(frame, lane)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multimedia chat server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help="listen() backlog")
+    parser.add_argument('--connect-rate', type=float, default=CONNECT_RATE, help="new connections admitted per second")
+    parser.add_argument('--connect-burst', type=int, default=CONNECT_BURST)
+    parser.add_argument('--max-handshakes', type=int, default=MAX_PENDING_HANDSHAKES, help="in-flight handshake limit")
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT)
+    parser.add_argument('--shed-video-bytes', type=int, default=SHED_VIDEO_BYTES, help="backlog above which video is dropped")
+    parser.add_argument('--throttle-file-bytes', type=int, default=THROTTLE_FILE_BYTES, help="backlog above which file frames are held back (without stalling the sender)")
+    parser.add_argument('--disconnect-bytes', type=int, default=DISCONNECT_BYTES, help="backlog above which a client is dropped")
+    parser.add_argument('--tls-cert', help="PEM certificate chain; enables TLS")
+    parser.add_argument('--tls-key', help="PEM private key (if not in --tls-cert)")
+    parser.add_argument('--plain-media', action='store_true', help="with TLS: let clients send call media over a separate plaintext connection")
+    parser.add_argument('--capture', metavar='TRACE', help="record inbound traffic for Chat_Replay.py")
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help=f"seconds before a quiet client is pinged; silent for {HEARTBEAT_MISSES}x this it is dropped (0: off)")
+    parser.add_argument('--flush-window', type=float, default=FLUSH_WINDOW * 1000,
+                        help="ms an idle connection waits for a burst to gather into one write")
+    parser.add_argument('--no-coalesce', action='store_true', help="one send call per frame (for comparison)")
+    parser.add_argument('--p2p-files', action='store_true', help="let clients send private files to each other directly "
+                                                                 "(brokered here, not encrypted)")
+    parser.add_argument('--handoff', metavar='PATH', help="Unix socket for zero-downtime restarts: a server started with "
+                                                          "the same PATH takes over this one's socket and sessions")
+    parser.add_argument('--admin', metavar='PATH', help="Unix socket for admin commands (python Chat_Profiler.py PATH profiles "
+                                                        "the running server)")
+    args = parser.parse_args()
+    policy = SlowConsumerPolicy(shed_video_bytes=args.shed_video_bytes, throttle_file_bytes=args.throttle_file_bytes,
+                                disconnect_bytes=args.disconnect_bytes)
+    server = ChatServer(host=args.host, port=args.port, listen_backlog=args.backlog,
+                        connect_rate=args.connect_rate, connect_burst=args.connect_burst,
+                        max_pending_handshakes=args.max_handshakes, handshake_timeout=args.handshake_timeout,
+                        slow_consumer_policy=policy,
+                        tls_context=make_tls_context(args.tls_cert, args.tls_key) if args.tls_cert else None,
+                        plain_media=args.plain_media, capture=args.capture, handoff=args.handoff,
+                        heartbeat_interval=args.heartbeat_interval,
+                        coalesce=not args.no_coalesce, flush_window=args.flush_window / 1000, p2p_files=args.p2p_files,
+                        admin=args.admin)
+    def stop(signum, frame): raise KeyboardInterrupt  # SIGTERM shuts down like Ctrl+C (flushes the trace)
+    signal.signal(signal.SIGTERM, stop)
     server.start()
\ No newline at end of file
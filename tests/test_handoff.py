@@ -0,0 +1,69 @@
+"""Zero-downtime restart: two --handoff servers on loopback, resuming clients under chat traffic."""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Chat_Benchmark import ResumingClient, _start_server
+
+RECEIVERS = 5
+INTERVAL = 0.01   # seconds between chat messages
+SETTLE = 1.0      # after the handoff, before traffic stops
+LATE = 0.5        # seconds one receiver waits before resuming: the new process must replay to it
+
+
+class LateResumer(ResumingClient):
+    def _connect(self):
+        if self.token: time.sleep(LATE)
+        return super()._connect()
+
+
+class HandoffTest(unittest.TestCase):
+    def test_handoff_resumes_sessions_without_loss(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'handoff.sock')
+            old, port = _start_server('--handoff', path)
+            new = None
+            clients = []
+            try:
+                receivers = [ResumingClient(port, f"r{i}") for i in range(RECEIVERS)] + [LateResumer(port, 'late')]
+                sender = ResumingClient(port, 'sender')
+                clients = receivers + [sender]
+                time.sleep(0.5)
+                sent, stop = [], threading.Event()
+                def traffic():
+                    while not stop.is_set():
+                        sent.append(str(len(sent)))
+                        sender.send({'type': 'chat', 'room': 'General', 'message': sent[-1]})
+                        time.sleep(INTERVAL)
+                threading.Thread(target=traffic, daemon=True).start()
+                time.sleep(0.5)
+
+                new, _ = _start_server('--handoff', path, port=port, wait=False)
+                self.assertEqual(old.wait(30), 0, "the old process should exit cleanly after handing over")
+                time.sleep(SETTLE)
+                stop.set()
+
+                deadline = time.monotonic() + 10
+                while time.monotonic() < deadline and any(len(c.received) < len(sent) for c in receivers):
+                    time.sleep(0.1)
+                self.assertTrue(any(c.reconnect_ms for c in clients), "clients never reconnected: no handoff happened")
+                for c in clients:
+                    self.assertEqual(c.resumed, 1, f"{c.name} got a fresh session instead of resuming")
+                    self.assertEqual(c.duplicates, 0, f"{c.name} got replayed duplicates")
+                    self.assertEqual(c.skipped, 0, f"{c.name} missed sequence numbers")
+                for c in receivers:
+                    self.assertEqual([m for m in sent if m not in c.received], [], f"{c.name} lost messages")
+            finally:
+                for c in clients: c.close()
+                for proc in (old, new):
+                    if proc and proc.poll() is None:
+                        proc.terminate(); proc.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""MessageIndex eviction: a capped index answers like one built from the messages it kept."""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Chat_Server import MessageIndex
+
+CAP = 640
+WORDS = ['alpha', 'alpine', 'beta', 'gamma', 'delta', 'echo', 'foxtrot', 'golf']
+QUERIES = ['alp', 'alpha', 'beta gamma', 'echo', 'golf delta', 'zulu']
+
+
+def messages(count, seed=1):
+    rng = random.Random(seed)
+    for n in range(count):
+        scope = rng.choice(['General', 'Dev', MessageIndex.private_scope('ann', 'bob')])
+        words = rng.sample(WORDS, 3) + [f'once{n}']  # every message has a word of its own
+        yield scope, rng.choice(['ann', 'bob', 'cy']), ' '.join(words), 1000.0 + n
+
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.capped = MessageIndex(max_messages=CAP)
+        self.all = list(messages(5 * CAP))
+        for scope, sender, text, when in self.all: self.capped.add(scope, sender, text, when)
+        self.kept = MessageIndex()
+        for scope, sender, text, when in self.all[self.capped.first:]: self.kept.add(scope, sender, text, when)
+
+    def test_bounded(self):
+        self.assertLessEqual(len(self.capped.texts), CAP)
+        self.assertGreater(self.capped.first, 0)
+        self.assertEqual(self.capped.horizon, self.all[self.capped.first - 1][3])
+        self.assertEqual(set(self.capped.postings), set(self.kept.postings))
+        self.assertEqual(list(self.capped.vocab.prefixed('once')), list(self.kept.vocab.prefixed('once')))
+        for plist in self.capped.postings.values(): self.assertGreaterEqual(plist[0], self.capped.first)
+
+    def test_same_answers_total_inexact(self):
+        for query in QUERIES:
+            for kw in ({}, {'scope': 'Dev'}, {'sender': 'cy'}, {'rooms': ['General']}, {'limit': 100}):
+                total, results, exact = self.capped.search(query, 'ann', **kw)
+                k_total, k_results, k_exact = self.kept.search(query, 'ann', **kw)
+                self.assertEqual(total, k_total)
+                self.assertEqual([(r['id'] - self.capped.first, r['message']) for r in results],
+                                 [(r['id'], r['message']) for r in k_results])
+                self.assertFalse(exact)
+
+    def test_exact_after_horizon(self):
+        since = self.capped.horizon + 0.5
+        total, results, exact = self.capped.search(f'once{self.capped.first}', 'ann', since=since)
+        self.assertEqual((total, len(results), exact), (1, 1, True))
+        self.assertEqual(self.capped.search(f'once{self.capped.first - 1}', 'ann'), (0, [], False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Brokered direct transfer: alice -> bob on loopback through a --p2p-files server."""
+
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Chat_Client
+from Chat_Benchmark import FileClient, _start_server
+from Chat_Protocol import P2P_MAX_BYTES
+
+SIZE = 3 * 1024 * 1024 + 17  # bytes; not a multiple of any buffer size
+
+
+class P2PTest(unittest.TestCase):
+    def setUp(self):
+        self.server, port = _start_server('--p2p-files')
+        self.alice = FileClient(port, 'alice', ['p2p_files'])
+        self.bob = FileClient(port, 'bob', ['p2p_files'])
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        for client in (self.alice, self.bob): client.sock.close()
+        self.server.terminate(); self.server.wait()
+        self.folder.cleanup()
+
+    def offer(self, transfer_id, **fields):
+        self.alice.send({'type': 'p2p_offer', 'recipient': 'bob', 'transfer_id': transfer_id,
+                         'filename': 'payload.bin', 'filetype': '.bin', **fields})
+
+    def test_transfer_is_intact_and_token_one_time(self):
+        path = os.path.join(self.folder.name, 'payload.bin')
+        with open(path, 'wb') as f: f.write(os.urandom(SIZE))
+        with open(path, 'rb') as f: digest = hashlib.sha256(f.read()).hexdigest()
+        sender = Chat_Client.P2PSender(path, timeout=10)
+        self.offer('t1', size=sender.size, port=sender.port)
+        sender.authorize(self.alice.wait_for('p2p_ready', timeout=10)['token'])
+        offer = self.bob.wait_for('p2p_offer', timeout=10)
+        self.assertEqual(offer['endpoints'], [['127.0.0.1', sender.port]])
+        self.assertEqual(offer['size'], SIZE)
+
+        forged = dict(offer, token='x' * len(offer['token']))
+        with self.assertRaises(ConnectionError):
+            Chat_Client.p2p_receive(forged, lambda: self.fail("forged token accepted"))
+        self.assertFalse(sender.sent)
+
+        target = os.path.join(self.folder.name, 'received.bin')
+        self.assertEqual(Chat_Client.p2p_receive(offer, lambda: (open(target, 'wb'), target)), target)
+        with open(target, 'rb') as f: self.assertEqual(hashlib.sha256(f.read()).hexdigest(), digest)
+
+        again = os.path.join(self.folder.name, 'again.bin')
+        with self.assertRaises(ConnectionError):
+            Chat_Client.p2p_receive(offer, lambda: (open(again, 'wb'), again))
+        self.assertFalse(os.path.exists(again))
+
+        self.bob.send({'type': 'p2p_result', 'transfer_id': 't1', 'ok': True})
+        self.assertTrue(self.alice.wait_for('p2p_result', timeout=10)['ok'])
+
+    def test_bad_offers_are_refused(self):
+        for transfer_id, fields in (('missing', {'port': 9}), ('text', {'port': 9, 'size': 'big'}),
+                                    ('huge', {'port': 9, 'size': P2P_MAX_BYTES + 1}),
+                                    ('port', {'port': 70000, 'size': 1})):
+            self.offer(transfer_id, **fields)
+            result = self.alice.wait_for('p2p_result', timeout=10)
+            self.assertEqual((result['transfer_id'], result['ok']), (transfer_id, False))
+        self.offer('hosts', port=9, size=1, hosts=['10.9.8.7'])
+        self.assertEqual(self.bob.wait_for('p2p_offer', timeout=10)['endpoints'], [['127.0.0.1', 9]])
+
+
+if __name__ == '__main__':
+    unittest.main()